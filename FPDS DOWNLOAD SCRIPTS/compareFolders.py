@@ -4,6 +4,11 @@
 # Date: September 2016
 # Purpose: Compares two folders matching by name.
 #          Compares file size, file date, and file hash
+#          Both folders are walked in sorted order and merged as they are read,
+#          so each row is written as soon as it is found and memory stays flat
+#          however many files the folders hold. Rows can be written to Parquet
+#          instead of CSV (pip install pyarrow), limited to mismatches, and
+#          summed up by agency.
 
 
 import os
@@ -11,6 +16,30 @@ import csv
 import datetime
 import hashlib
 import ctypes
+import collections
+from itertools import islice
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from fpds_catalog import agency_of
+
+#rows written to Parquet at a time
+BATCH_SIZE = 65536
+
+#one file's stats; name is the file name relative to the folder, which the rows are sorted by
+FileStat = collections.namedtuple('FileStat', ('name', 'size', 'mtime', 'md5'))
+
+FIELDS = ('File Name', 'File Size 1', 'File Size 2',
+    'File Size % Difference', 'File Date 1', 'File Date 2',
+    'File Date Same?')
+HASH_FIELDS = ('File Hash 1', 'File Hash 2', 'File Hash Same?')
+SUMMARY_FIELDS = ('Agency', 'Files 1', 'Files 2', 'Only In 1', 'Only In 2',
+    'Size Mismatches', 'Date Mismatches', 'Hash Mismatches',
+    'Total Size 1', 'Total Size 2', 'Total Size Difference')
 
 def filemd5(fname):
     """Return MD5 hash of a file
@@ -21,80 +50,178 @@ def filemd5(fname):
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
+def walkSorted(path):
+    """Walk a folder in the order its relative path strings sort
+
+    Yield the path of each file. Within a folder, subfolders sort as their
+    name plus the separator, so a file named "sub-x" comes before the files
+    under "sub" just as "/sub-x" sorts before "/sub/...".
+    """
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return
+    def order(entry):
+        if entry.is_dir(): return entry.name + os.sep
+        return entry.name
+    for entry in sorted(entries, key=order):
+        if entry.is_dir():
+            #like os.walk, links to folders are not followed
+            if not entry.is_symlink(): yield from walkSorted(entry.path)
+        else: yield entry.path
+
 def getStats(path, md5_on):
     """Get file stats
 
-    Return file name, file size, file modified time, and md5 hash
+    Yield a FileStat of file name, file size, file modified time, and md5
+    hash for each file, sorted by file name relative to path.
+    """
+    for filename in walkSorted(path):
+        stat = os.stat(filename)
+        if md5_on: statmd5 = filemd5(filename)
+        else: statmd5 = None
+        yield FileStat(filename[len(path):], stat.st_size, stat.st_mtime, statmd5)
+
+def mergeStats(stats1, stats2):
+    """Merge two sorted FileStat streams
+
+    Yield (file name, stat 1, stat 2), with None for the side missing a file.
+    """
+    stat1 = next(stats1, None)
+    stat2 = next(stats2, None)
+    while stat1 is not None or stat2 is not None:
+        if stat2 is None or (stat1 is not None and stat1.name < stat2.name):
+            yield stat1.name, stat1, None
+            stat1 = next(stats1, None)
+        elif stat1 is None or stat2.name < stat1.name:
+            yield stat2.name, None, stat2
+            stat2 = next(stats2, None)
+        else:
+            yield stat1.name, stat1, stat2
+            stat1 = next(stats1, None)
+            stat2 = next(stats2, None)
+
+def fileDate(mtime):
+    """Format a modified time for the report"""
+    if mtime is None: return None
+    return datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+
+def compareRows(path1, path2, md5_on, mismatch_only=False, totals=None):
+    """Compare two folders row by row
+
+    Yield one tuple per file in FIELDS order (plus HASH_FIELDS if md5_on).
+    If mismatch_only, files that match on both sides are left out.
+    If totals is a dict, counts by agency are added to it.
     """
-    for pathname, dirnames, filenames in os.walk(path):
-        for filename in ( os.path.join(pathname, x) for x in filenames ):
-            stat = os.stat(filename)
-            if md5_on: statmd5 = filemd5(filename)
-            else: statmd5 = None
-            yield filename[len(path):], stat.st_size, stat.st_mtime, statmd5
-
-def compareFolders(path1,path2,output):
+    for filename, stat1, stat2 in mergeStats(getStats(path1, md5_on),
+            getStats(path2, md5_on)):
+        filesize1 = stat1.size if stat1 else None
+        filesize2 = stat2.size if stat2 else None
+        if None not in {filesize1,filesize2} and filesize1:
+            percdif = (filesize2-filesize1)/filesize1*100
+        else: percdif=None
+        mtime1 = stat1.mtime if stat1 else None
+        mtime2 = stat2.mtime if stat2 else None
+        datesame = mtime1 == mtime2
+        hash1 = stat1.md5 if stat1 else None
+        hash2 = stat2.md5 if stat2 else None
+        hashsame = hash1 == hash2
+        if totals is not None:
+            addTotals(totals, filename, filesize1, filesize2, datesame, hashsame)
+        if mismatch_only and stat1 and stat2 and filesize1 == filesize2 \
+                and datesame and hashsame:
+            continue
+        row = (filename, filesize1, filesize2, percdif, fileDate(mtime1),
+            fileDate(mtime2), datesame)
+        if md5_on: row += (hash1, hash2, hashsame)
+        yield row
+
+def addTotals(totals, filename, filesize1, filesize2, datesame, hashsame):
+    """Add one file to the counts for its agency"""
+    agency = agency_of(os.path.basename(filename))[1]
+    counts = totals.get(agency)
+    if counts is None: counts = totals[agency] = [0] * (len(SUMMARY_FIELDS) - 2)
+    both = filesize1 is not None and filesize2 is not None
+    counts[0] += filesize1 is not None
+    counts[1] += filesize2 is not None
+    counts[2] += filesize2 is None
+    counts[3] += filesize1 is None
+    counts[4] += both and filesize1 != filesize2
+    counts[5] += both and not datesame
+    counts[6] += both and not hashsame
+    counts[7] += filesize1 or 0
+    counts[8] += filesize2 or 0
+
+def writeCSV(path, path1, path2, fields, rows):
+    """Write report rows to a csv file"""
+    with open (path,'w') as csvfile:
+        csv_compare = csv.writer(csvfile, lineterminator = '\n')
+        blank = [""] * (len(fields) - 1)
+        csv_compare.writerow(["File 1: %s" % path1] + blank)
+        csv_compare.writerow(["File 2: %s" % path2] + blank)
+        csv_compare.writerow([""] + blank)
+        csv_compare.writerow(fields)
+        csv_compare.writerows(rows)
+
+def writeParquet(path, fields, rows):
+    """Write report rows to a Parquet file, BATCH_SIZE rows at a time"""
+    types = [pyarrow.string(), pyarrow.int64(), pyarrow.int64(),
+        pyarrow.float64(), pyarrow.string(), pyarrow.string(), pyarrow.bool_(),
+        pyarrow.string(), pyarrow.string(), pyarrow.bool_()]
+    schema = pyarrow.schema(list(zip(fields, types)))
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if not batch: break
+            columns = [pyarrow.array(column, type=t)
+                for column, t in zip(zip(*batch), types)]
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+
+def compareFolders(path1,path2,output,md5_on=None,mismatch_only=False,
+        summary=False,format="csv"):
     """Compare two folders
 
-    Take two folders and compare the file contents. Output a csv file.
+    Take two folders and compare the file contents. Output a csv file
+    (or compareFolders.parquet if format is "parquet").
+    If md5_on is None, a message box asks whether to compare md5 hashes.
+    If mismatch_only, only files that differ or are missing from one folder
+    are written. If summary, counts and size differences by agency are also
+    written to compareFolders_summary.csv.
+    Return a dict of agency code to summary counts in SUMMARY_FIELDS order,
+    with a 'TOTAL' entry.
     """
-    md5_on = ctypes.windll.user32.MessageBoxW(0, "Do you want to run md5 hash "
+    if md5_on is None: md5_on = ctypes.windll.user32.MessageBoxW(0, "Do you want to run md5 hash "
         "check?\nNote: The script could take several hours instead of less than"
         " a minute.", "md5 Confirmation", 4)==6
-    FileFolder1=list(getStats(path1, md5_on))
-    FileFolder2=list(getStats(path2, md5_on))
-    dict1 = dict((each[0], each[1:]) for each in FileFolder1)
-    dict2 = dict((each[0], each[1:]) for each in FileFolder2)
-    dictall = dict((k, [dict1[k], dict2.get(k)]) for k in dict1)
-    dictall.update((k, [(None,None,None), dict2[k]]) 
-        for k in dict2 if k not in dict1)
-    dictall.update((k, [dict1[k],(None,None,None)]) 
-        for k in dict1 if k not in dict2)
-    
-    with open (os.path.join(output, "compareFolders.csv"),'w') as csvfile:
-        fields = ('File Name', 'File Size 1', 'File Size 2', 
-            'File Size % Difference', 'File Date 1', 'File Date 2', 
-            'File Date Same?') + md5_on 
-            * ('File Hash 1', 'File Hash 2', 'File Hash Same?')
-        csv_compare = csv.DictWriter(
-            csvfile, fieldnames=fields, lineterminator = '\n')
-        csv_compare.writerow({'File Name': "File 1: %s" % path1})
-        csv_compare.writerow({'File Name': "File 2: %s" % path2})
-        csv_compare.writerow({'File Name': ""})
-
-        csv_compare.writeheader()
-        for key, value in sorted(dictall.items()):
-            print("Checking %s." %(key))                 
-            filename = key
-            filesize1 = value[0][0]
-            filesize2 = value[1][0]
-            if None not in {filesize1,filesize2}:
-                percdif = (filesize2-filesize1)/filesize1*100
-            else: percdif=None
-            if value[0][1]!=None:
-                date1 = datetime.datetime.fromtimestamp(
-                    value[0][1]).strftime('%Y-%m-%d %H:%M:%S')
-            else: date1=None
-            if value[1][1]!=None:
-                date2 = datetime.datetime.fromtimestamp(
-                    value[1][1]).strftime('%Y-%m-%d %H:%M:%S')
-            else: date2=None
-            datesame = value[0][1] == value[1][1]
-            hash1 = value[0][2]
-            hash2 = value[1][2]
-            hashsame = hash1 == hash2
-            row = {'File Name':filename, 'File Size 1':filesize1, 
-                'File Size 2':filesize2, 'File Size % Difference':percdif, 
-                'File Date 1':date1,'File Date 2':date2, 
-                'File Date Same?':datesame}
-            if md5_on: row.update({'File Hash 1': hash1, 'File Hash 2': hash2, 
-                'File Hash Same?':hashsame})
-            csv_compare.writerow(row)
-    return(dictall)
-
-#path for folders to compare
-p1=r""
-p2=r""
-#output path
-PATH=r""
-compareFolders(p1,p2,PATH)
\ No newline at end of file
+    if format == "parquet" and pyarrow is None:
+        raise ImportError("Parquet output needs pyarrow: pip install pyarrow")
+    fields = FIELDS + md5_on * HASH_FIELDS
+    totals = {}
+    rows = compareRows(path1, path2, md5_on, mismatch_only, totals)
+    if format == "parquet":
+        writeParquet(os.path.join(output, "compareFolders.parquet"), fields, rows)
+    else:
+        writeCSV(os.path.join(output, "compareFolders.csv"), path1, path2,
+            fields, rows)
+    total = [sum(column) for column in zip(*totals.values())] or \
+        [0] * (len(SUMMARY_FIELDS) - 2)
+    totals = dict(sorted(totals.items()))
+    totals['TOTAL'] = total
+    if summary:
+        with open (os.path.join(output, "compareFolders_summary.csv"),'w') as csvfile:
+            csv_summary = csv.writer(csvfile, lineterminator = '\n')
+            csv_summary.writerow(SUMMARY_FIELDS)
+            for agency, counts in totals.items():
+                csv_summary.writerow([agency] + counts + [counts[8] - counts[7]])
+    print("Compared %s files: %s only in 1, %s only in 2, %s size, %s date and "
+        "%s hash mismatches." % (total[0] + total[3], total[2], total[3],
+        total[4], total[5], total[6]))
+    return(totals)
+
+if __name__ == "__main__":
+    #path for folders to compare
+    p1=r""
+    p2=r""
+    #output path
+    PATH=r""
+    compareFolders(p1,p2,PATH)
@@ -0,0 +1,300 @@
+# fpds_benchmark
+###############################
+# Purpose: Times the FPDS download pipeline against the local mock server.
+#          Runs the directory, download, extract, hash and compare paths for
+#          each year the mock site publishes and reports seconds, MB/s and
+#          peak memory for each one. Every run is appended to a history CSV
+#          so that results can be compared from change to change.
+#          With --transports it instead compares the threaded and asyncio
+#          transports in fpds_transport.py on the probe and download paths, and
+#          with --backends it times unzipping with each inflate backend in
+#          fpds_inflate.py and zstd recompression of the consolidated zip file.
+#
+# Usage:   python fpds_benchmark.py --years 2006 2016 --agencies 8 --size 20 --label "chunk 1k"
+#          python fpds_benchmark.py --transports --agencies 40 --size 5 --latency 0.05 --concurrency 32
+#          python fpds_benchmark.py --backends --agencies 6 --size 50 --zstd-level 9
+#          python fpds_benchmark.py --show-history
+#          CPU seconds include the mock server's threads unless it runs in its own process
+#          (python fpds_mock_server.py ... then --base-url with the url it prints).
+
+import os, sys, csv, time, zlib, shutil, zipfile, argparse, tempfile, contextlib, requests
+from datetime import datetime
+
+import fpds_common
+import fpds_mock_server
+import fpds_transport
+import fpds_inflate
+from compareFolders import compareFolders, filemd5
+
+#columns of the history CSV
+HISTORY_FIELDS = ('Run', 'Label', 'Phase', 'Seconds', 'CPU Seconds', 'MB', 'MB/s', 'Peak RSS MB', 'Settings')
+
+
+def peak_rss():
+    """Gets the peak resident memory of this process in MB, or None if it cannot be read."""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #Linux reports KB, macOS reports bytes
+        return peak/1000000 if sys.platform == "darwin" else peak/1000
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    #Windows reports the peak working set; elsewhere fall back to the current size
+    return getattr(info, "peak_wset", info.rss)/1000000
+
+
+class Phases:
+    """Collects the timing of each phase of a benchmark run."""
+
+    def __init__(self):
+        self.results = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block. The block sets the yielded dict's 'bytes' to the data it handled."""
+        measure = {'bytes': 0}
+        began = time.perf_counter()
+        cpu = time.process_time()
+        yield measure
+        seconds = time.perf_counter() - began
+        cpu = time.process_time() - cpu
+        mb = measure['bytes']/1000000
+        self.results.append({'Phase': name, 'Seconds': round(seconds, 3), 'CPU Seconds': round(cpu, 3), 'MB': round(mb, 3),
+            'MB/s': round(mb/seconds, 3) if seconds and mb else None, 'Peak RSS MB': peak_rss()})
+
+
+def tree_size(path):
+    """Total bytes of every file under path."""
+    return sum(os.stat(os.path.join(p, f)).st_size for p, d, files in os.walk(path) for f in files)
+
+
+def run_year(year, base_url, work_dir, phases, chunk_size):
+    """Runs the download pipeline for one year of the mock site, timing each phase.
+
+    Arg:
+            year: Fiscal Year to download.
+            base_url: Url of the mock site.
+            work_dir: Folder the year folder and compare output are written in.
+            phases: Phases object the timings are added to.
+            chunk_size: Bytes read from the server per chunk.
+    Returns:
+            Nothing.
+    """
+    PATH = os.path.join(work_dir, "FPDS_FY%s" % year)
+    os.makedirs(PATH, exist_ok=True)
+    with open(os.path.join(PATH, "FPDS_DL_log_file.log"), 'w') as logfile, open(os.devnull, 'w') as quiet:
+        with phases.phase("directory FY%s" % year) as m:
+            directory_url, pref = fpds_common.find_directory(year, base_url)
+            html = requests.get(directory_url).text
+            links = fpds_common.find_id(html, logfile)
+            zip_urls = fpds_common.archive_urls(links, pref, fpds_common.archive_suffix(year))
+            m['bytes'] = len(html)
+        downloaded = []
+        with phases.phase("download FY%s" % year) as m, contextlib.redirect_stdout(quiet):
+            for u in zip_urls:
+                file_name_and_path, retrieved, hashes = fpds_common.download_archive(u, PATH, logfile, chunk_size)
+                if os.path.isfile(file_name_and_path):
+                    downloaded.append((file_name_and_path, u))
+                    m['bytes'] += os.stat(file_name_and_path).st_size
+        with phases.phase("extract FY%s" % year) as m:
+            for file_name_and_path, u in downloaded:
+                for member in fpds_common.extract_archive(file_name_and_path, u, PATH, logfile, unzip_limit=None):
+                    if member['unzipped']:
+                        m['bytes'] += member['size']
+        with phases.phase("hash FY%s" % year) as m:
+            for p, d, files in os.walk(PATH):
+                for f in files:
+                    filemd5(os.path.join(p, f))
+                    m['bytes'] += os.stat(os.path.join(p, f)).st_size
+        #compare the year folder with an untimed copy of itself
+        shutil.copytree(PATH, PATH + "_copy")
+        with phases.phase("compare FY%s" % year) as m, contextlib.redirect_stdout(quiet):
+            compareFolders(PATH, PATH + "_copy", work_dir, md5_on=False)
+            m['bytes'] = tree_size(PATH)*2
+
+
+def run_transports(year, base_url, work_dir, phases, concurrency, probe_repeat):
+    """Times probing and downloading one year with each transport.
+
+    Arg:
+            year: Fiscal Year to download.
+            base_url: Url of the mock site.
+            work_dir: Folder each transport's year folder is written in.
+            phases: Phases object the timings are added to.
+            concurrency: Downloads at once.
+            probe_repeat: Times each zip url is probed, to reach hundreds of probes at once.
+    Returns:
+            Nothing.
+    """
+    with open(os.devnull, 'w') as quiet:
+        directory_url, pref = fpds_common.find_directory(year, base_url)
+        links = fpds_common.find_id(requests.get(directory_url).text, quiet)
+        zip_urls = fpds_common.archive_urls(links, pref, fpds_common.archive_suffix(year))
+        engines = ["threads"] + ["async"]*(fpds_transport.aiohttp is not None)
+        if fpds_transport.aiohttp is None:
+            print("aiohttp is not installed; timing the threaded transport only")
+        for engine in engines:
+            transport = fpds_transport.make_transport(engine, concurrency)
+            #each repeat gets its own query string, since probe returns one status per distinct url
+            probes = ["%s?probe=%s" % (u, i) for i in range(probe_repeat) for u in zip_urls]
+            with phases.phase("probe %s FY%s" % (engine, year)) as m:
+                statuses = transport.probe(probes)
+                m['bytes'] = 0
+            print("%s: %s probes, %s answered" % (engine, len(probes), sum(1 for s in statuses.values() if s)))
+            PATH = os.path.join(work_dir, "FPDS_FY%s_%s" % (year, engine))
+            os.makedirs(PATH, exist_ok=True)
+            with phases.phase("download %s FY%s" % (engine, year)) as m, contextlib.redirect_stdout(quiet):
+                results = transport.download(zip_urls, PATH, quiet)
+                m['bytes'] = sum(os.stat(path).st_size for path, retrieved, hashes in results.values() if os.path.isfile(path))
+
+
+def run_backends(year, base_url, work_dir, phases, zstd_level):
+    """Times unzipping one year with each installed inflate backend, then zstd recompression.
+
+    Arg:
+            year: Fiscal Year to download.
+            base_url: Url of the mock site.
+            work_dir: Folder the year folder is written in.
+            phases: Phases object the timings are added to.
+            zstd_level: zstd level for recompressing the consolidated zip file.
+    Returns:
+            Nothing.
+    """
+    PATH = os.path.join(work_dir, "FPDS_FY%s" % year)
+    os.makedirs(PATH, exist_ok=True)
+    with open(os.path.join(PATH, "FPDS_DL_log_file.log"), 'w') as logfile, open(os.devnull, 'w') as quiet:
+        directory_url, pref = fpds_common.find_directory(year, base_url)
+        links = fpds_common.find_id(requests.get(directory_url).text, logfile)
+        zip_urls = fpds_common.archive_urls(links, pref, fpds_common.archive_suffix(year))
+        downloaded = []
+        with contextlib.redirect_stdout(quiet):
+            for u in zip_urls:
+                file_name_and_path, retrieved, hashes = fpds_common.download_archive(u, PATH, logfile)
+                if os.path.isfile(file_name_and_path):
+                    downloaded.append((file_name_and_path, u))
+        for backend in fpds_inflate.available_backends():
+            #inflating alone, then unzipping as fpds_dl.py does, which also writes and hashes
+            with phases.phase("inflate %s FY%s" % (backend, year)) as m:
+                for file_name_and_path, u in downloaded:
+                    #malformed archives and members are skipped, as extract_archive skips them,
+                    #so every phase counts the same bytes
+                    try:
+                        with open(file_name_and_path, 'rb') as f, zipfile.ZipFile(f) as z:
+                            for member in z.infolist():
+                                size = 0
+                                try:
+                                    for chunk in fpds_inflate.member_chunks(z, f, member, backend):
+                                        size += len(chunk)
+                                except (zipfile.error, zlib.error, EOFError):
+                                    continue
+                                m['bytes'] += size
+                    except zipfile.error:
+                        pass
+            unzipped = os.path.join(work_dir, "FY%s_%s" % (year, backend))
+            os.makedirs(unzipped, exist_ok=True)
+            with phases.phase("extract %s FY%s" % (backend, year)) as m:
+                for file_name_and_path, u in downloaded:
+                    for member in fpds_common.extract_archive(file_name_and_path, u, unzipped, logfile, None, backend):
+                        if member['unzipped']:
+                            m['bytes'] += member['size']
+            shutil.rmtree(unzipped)
+        if not fpds_inflate.ZSTD_AVAILABLE:
+            print("zstd is not installed; skipping recompression")
+            return
+        for file_name_and_path, u in downloaded:
+            fpds_common.consolidate_archive(file_name_and_path, PATH, logfile)
+        with phases.phase("zstd %s FY%s" % (zstd_level, year)) as m:
+            target, m['bytes'], skipped = fpds_inflate.recompress(PATH + ".zip", level=zstd_level)
+        print("FY%s: %s bytes of XML, %s bytes zipped, %s bytes as zstd level %s" % (year, m['bytes'],
+            os.stat(PATH + ".zip").st_size, os.stat(target).st_size, zstd_level))
+
+
+def write_history(history, label, settings, results):
+    """Appends the phases of a run to the history CSV."""
+    new = not os.path.isfile(history)
+    run = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with open(history, 'a') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=HISTORY_FIELDS, lineterminator='\n')
+        if new:
+            writer.writeheader()
+        for row in results:
+            writer.writerow(dict(row, Run=run, Label=label, Settings=settings))
+
+
+def show_history(history, runs):
+    """Prints the last few runs of each phase from the history CSV, oldest first."""
+    with open(history) as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    by_phase = {}
+    for row in rows:
+        by_phase.setdefault(row['Phase'], []).append(row)
+    for name in sorted(by_phase):
+        print(name)
+        for row in by_phase[name][-runs:]:
+            print("  %s  %-20s %8ss %10s MB/s  %s MB peak" % (row['Run'], row['Label'][:20], row['Seconds'],
+                row['MB/s'] or "-", row['Peak RSS MB'] or "-"))
+
+
+def print_results(results):
+    """Prints one line per phase."""
+    print("%-24s %10s %10s %10s %10s %12s" % ("Phase", "Seconds", "CPU", "MB", "MB/s", "Peak RSS MB"))
+    for row in results:
+        print("%-24s %10s %10s %10s %10s %12s" % (row['Phase'], row['Seconds'], row['CPU Seconds'], row['MB'], row['MB/s'] or "-",
+            "%.1f" % row['Peak RSS MB'] if row['Peak RSS MB'] else "-"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the FPDS download pipeline against a local mock server.")
+    parser.add_argument("--work-dir", help="folder for the mock site and downloads (default: a temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="keep the work folder afterwards")
+    parser.add_argument("--chunk-size", type=int, default=fpds_common.CHUNK_SIZE, help="bytes read from the server per chunk")
+    parser.add_argument("--transports", action="store_true", help="compare the threaded and async transports instead")
+    parser.add_argument("--concurrency", type=int, default=16, help="downloads at once for --transports")
+    parser.add_argument("--probe-repeat", type=int, default=20, help="times each url is probed for --transports")
+    parser.add_argument("--backends", action="store_true", help="compare the inflate backends and zstd instead")
+    parser.add_argument("--zstd-level", type=int, default=fpds_inflate.ZSTD_LEVEL, help="zstd level for --backends")
+    parser.add_argument("--base-url", help="use a mock server already running at this url instead of starting one")
+    parser.add_argument("--label", default="", help="name for this run in the history")
+    parser.add_argument("--history", default="fpds_benchmark_history.csv", help="CSV the results are appended to")
+    parser.add_argument("--show-history", type=int, nargs="?", const=5, metavar="RUNS",
+        help="print the last RUNS runs of each phase from the history and exit")
+    fpds_mock_server.add_arguments(parser)
+    args = parser.parse_args()
+    if args.show_history:
+        show_history(args.history, args.show_history)
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="fpds_benchmark_")
+    mock = fpds_mock_server.from_arguments(args, os.path.join(work_dir, "mock"))
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        print("Building mock archives in %s" % work_dir)
+        mock.build()
+        base_url = mock.start()
+    phases = Phases()
+    try:
+        for year in mock.years:
+            if args.transports:
+                run_transports(year, base_url, work_dir, phases, args.concurrency, args.probe_repeat)
+            elif args.backends:
+                run_backends(year, base_url, work_dir, phases, args.zstd_level)
+            else:
+                run_year(year, base_url, work_dir, phases, args.chunk_size)
+    finally:
+        mock.stop()
+        if not (args.keep or args.work_dir):
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print_results(phases.results)
+    settings = " ".join(a for a in sys.argv[1:] if a != "--keep")
+    write_history(args.history, args.label, settings, phases.results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+# fpds_catalog
+###############################
+# Purpose: One catalog of every agency zip file downloaded for every year.
+#          A SQLite database next to the year folders, indexed on year,
+#          agency code, member name and hash, answers "which archive holds
+#          agency X for FY Y, and what is its md5 and size" without reading
+#          logs or opening zip files. fpds_dl.py adds each archive as it
+#          finishes it and records where each archive sits inside the
+#          consolidated FPDS_FYyyyy.zip, so an archive can be copied straight
+#          out of it.
+#
+# Usage:   python fpds_catalog.py D:\data\fpds\downloaded find --year 2016 --agency 9700
+#          python fpds_catalog.py D:\data\fpds\downloaded find --member "*-IDV.xml" --year 2010
+#          python fpds_catalog.py D:\data\fpds\downloaded find --md5 0cc175b9c0f1b6a831c399e269772661
+#          python fpds_catalog.py D:\data\fpds\downloaded extract 2016 9700 D:\temp
+#          python fpds_catalog.py D:\data\fpds\downloaded index     (catalog year folders downloaded before the catalog)
+
+import os, re, sys, glob, json, struct, sqlite3, zipfile, argparse
+
+from fpds_manifest import load_manifest
+
+CATALOG_NAME = "FPDS_catalog.sqlite"
+#length of a zip local file header before its file name and extra field
+LOCAL_HEADER_SIZE = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    year INTEGER NOT NULL,
+    agency_code TEXT NOT NULL,
+    agency TEXT,
+    name TEXT NOT NULL,
+    url TEXT,
+    size INTEGER,
+    mtime REAL,
+    md5 TEXT,
+    sha256 TEXT,
+    idv INTEGER,
+    award INTEGER,
+    consolidated TEXT,
+    header_offset INTEGER,
+    data_offset INTEGER,
+    stored INTEGER,
+    UNIQUE (year, name)
+);
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY,
+    archive_id INTEGER NOT NULL REFERENCES archives (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    crc INTEGER,
+    md5 TEXT,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS archives_agency ON archives (agency_code, year);
+CREATE INDEX IF NOT EXISTS archives_agency_id ON archives (agency);
+CREATE INDEX IF NOT EXISTS archives_year ON archives (year);
+CREATE INDEX IF NOT EXISTS archives_md5 ON archives (md5);
+CREATE INDEX IF NOT EXISTS archives_sha256 ON archives (sha256);
+CREATE INDEX IF NOT EXISTS members_archive ON members (archive_id);
+CREATE INDEX IF NOT EXISTS members_name ON members (name);
+CREATE INDEX IF NOT EXISTS members_md5 ON members (md5);
+CREATE INDEX IF NOT EXISTS members_sha256 ON members (sha256);
+"""
+
+
+def connect(root):
+    """Opens the catalog in the folder containing the year folders, creating it if needed."""
+    db = sqlite3.connect(os.path.join(root, CATALOG_NAME), timeout=60)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA foreign_keys = ON")
+    db.executescript(SCHEMA)
+    return db
+
+
+def agency_of(name, url=None):
+    """Gets the agency ID and agency code of an agency zip file.
+
+    The agency ID is the folder in the zip file's url, e.g. 0300-LIBRARYOFCONGRESS, and the
+    code is its leading four characters, e.g. 0300. Without a url the ID is read from the
+    file name, which for OTHER_DOD_AGENCIES is DOD-OTHER_DOD.
+    """
+    if url:
+        agency = url.rstrip("/").split("/")[-2]
+    else:
+        agency = re.sub("-DEPT.*$", "", name)
+    match = re.match("([0-9A-Z]{4})-", agency)
+    return agency, match.group(1) if match else agency
+
+
+def add_archive(db, year, name, record):
+    """Adds or replaces one agency zip file and its members.
+
+    Arg:
+            db: Catalog from connect.
+            year: Fiscal Year.
+            name: File name of the agency zip file.
+            record: Archive record from fpds_manifest.add_archive.
+    Returns:
+            The archive's row id.
+    """
+    agency, code = agency_of(name, record.get('url'))
+    with db:
+        db.execute("DELETE FROM archives WHERE year = ? AND name = ?", (year, name))
+        archive_id = db.execute("INSERT INTO archives (year, agency_code, agency, name, url, size, mtime, md5, sha256, idv, award) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (year, code, agency, name, record.get('url'), record['size'],
+            record['mtime'], record.get('md5'), record.get('sha256'), record.get('idv'), record.get('award'))).lastrowid
+        db.executemany("INSERT INTO members (archive_id, name, size, mtime, crc, md5, sha256) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(archive_id, m['name'], m['size'], m['mtime'], m.get('crc'), m.get('md5'), m.get('sha256')) for m in record['members']])
+    return archive_id
+
+
+def index_consolidated(db, year, consolidated):
+    """Records where each agency zip file of a year sits inside its consolidated zip file.
+
+    The data offset is read from each local file header, since its extra field can differ
+    from the central directory's.
+
+    Arg:
+            db: Catalog from connect.
+            year: Fiscal Year.
+            consolidated: Path of the consolidated zip file.
+    Returns:
+            The number of archives located.
+    """
+    located = 0
+    with open(consolidated, 'rb') as f, zipfile.ZipFile(f, allowZip64=True) as z, db:
+        for info in z.infolist():
+            f.seek(info.header_offset)
+            header = f.read(LOCAL_HEADER_SIZE)
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            data_offset = info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length
+            located += db.execute("UPDATE archives SET consolidated = ?, header_offset = ?, data_offset = ?, stored = ? "
+                "WHERE year = ? AND name = ?", (os.path.basename(consolidated), info.header_offset, data_offset,
+                int(info.compress_type == zipfile.ZIP_STORED), year, os.path.basename(info.filename))).rowcount
+    return located
+
+
+def index_year(db, PATH, year):
+    """Catalogs a year folder from its manifest and consolidated zip file."""
+    manifest = load_manifest(PATH, year)
+    for name, record in manifest['archives'].items():
+        add_archive(db, year, name, record)
+    if os.path.isfile(PATH + ".zip"):
+        index_consolidated(db, year, PATH + ".zip")
+    return len(manifest['archives'])
+
+
+def index(root):
+    """Catalogs every year folder under root that has a manifest.
+
+    Returns:
+            The number of archives cataloged.
+    """
+    db = connect(root)
+    total = 0
+    for path in sorted(glob.glob(os.path.join(root, "FPDS_FY*", "FPDS_manifest_FY*.json"))):
+        year = int(re.search(r"FPDS_manifest_FY(\d+)\.json$", path).group(1))
+        total += index_year(db, os.path.dirname(path), year)
+    db.close()
+    return total
+
+
+def select(db, where, params, members):
+    """Runs an archive query, joined to the members table if members is True."""
+    columns = "a.*" + (", m.name AS member, m.size AS member_size, m.md5 AS member_md5" if members else "")
+    join = "JOIN members m ON m.archive_id = a.id" if members else ""
+    query = "SELECT %s FROM archives a %s %s ORDER BY a.year, a.agency_code, a.name" % (
+        columns, join, "WHERE " + " AND ".join(where) if where else "")
+    return [dict(row) for row in db.execute(query, params)]
+
+
+def find(db, year=None, agency=None, member=None, md5=None, sha256=None):
+    """Looks up agency zip files.
+
+    Arg:
+            db: Catalog from connect.
+            year: Fiscal Year.
+            agency: Agency code (0300) or agency ID (0300-LIBRARYOFCONGRESS).
+            member: Name of a file inside the archive; * and ? match like in file names.
+            md5: md5 of the archive or of a file inside it.
+            sha256: sha256 of the archive or of a file inside it.
+    Returns:
+            A list of dicts, one per matching archive, or one per matching file inside an archive
+            (with 'member', 'member_size' and 'member_md5') when member or a member's hash matched.
+    """
+    where, params = [], []
+    if year is not None:
+        where.append("a.year = ?")
+        params.append(year)
+    if agency:
+        where.append("(a.agency_code = ? OR a.agency = ?)")
+        params += [agency, agency]
+    if member:
+        where.append("m.name %s ?" % ("GLOB" if re.search(r"[*?\[]", member) else "="))
+        params.append(member)
+    hashes = [(kind, value.lower()) for kind, value in (('md5', md5), ('sha256', sha256)) if value]
+    if not hashes:
+        return select(db, where, params, bool(member))
+    hash_params = params + [value for kind, value in hashes]
+    rows = []
+    #archive hashes and member hashes are separate indexes, so ask each one on its own
+    if not member:
+        rows += select(db, where + ["a.%s = ?" % kind for kind, value in hashes], hash_params, False)
+    rows += select(db, where + ["m.%s = ?" % kind for kind, value in hashes], hash_params, True)
+    return rows
+
+
+def extract(root, row, dest):
+    """Copies one agency zip file out of its year's consolidated zip file.
+
+    The archive is stored without compression, so its bytes are copied straight from the
+    recorded data offset.
+
+    Returns:
+            Path of the copied zip file.
+    """
+    consolidated = os.path.join(root, row['consolidated'])
+    target = os.path.join(dest, row['name'])
+    if not row['stored']:
+        with zipfile.ZipFile(consolidated, allowZip64=True) as z, z.open(row['name']) as src, open(target, 'wb') as out:
+            for chunk in iter(lambda: src.read(1048576), b""):
+                out.write(chunk)
+        return target
+    with open(consolidated, 'rb') as src, open(target, 'wb') as out:
+        src.seek(row['data_offset'])
+        left = row['size']
+        while left:
+            chunk = src.read(min(left, 1048576))
+            if not chunk:
+                raise IOError("%s ends before %s" % (consolidated, row['name']))
+            out.write(chunk)
+            left -= len(chunk)
+    os.utime(target, (row['mtime'], row['mtime']))
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up FPDS agency zip files across years.")
+    parser.add_argument("root", help="folder containing the FPDS_FYyyyy year folders and the catalog")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("index", help="catalog every year folder that has a manifest")
+    lookup = commands.add_parser("find", help="look up archives")
+    lookup.add_argument("--year", type=int)
+    lookup.add_argument("--agency", help="agency code or ID")
+    lookup.add_argument("--member", help="file name inside the archive; * and ? are wildcards")
+    lookup.add_argument("--md5")
+    lookup.add_argument("--sha256")
+    lookup.add_argument("--json", action="store_true", help="print JSON instead of a table")
+    copy = commands.add_parser("extract", help="copy an agency's archive for a year out of the consolidated zip")
+    copy.add_argument("year", type=int)
+    copy.add_argument("agency", help="agency code or ID")
+    copy.add_argument("dest", help="folder to copy it to")
+    args = parser.parse_args()
+
+    if args.command == "index":
+        print("%s archives cataloged" % index(args.root))
+        return
+    db = connect(args.root)
+    if args.command == "find":
+        rows = find(db, args.year, args.agency, args.member, args.md5, args.sha256)
+        if args.json:
+            json.dump(rows, sys.stdout, indent=1)
+            print()
+        for row in rows if not args.json else []:
+            print("FY%s\t%s\t%s\t%s bytes\tmd5: %s\t%s%s" % (row['year'], row['agency_code'], row['name'], row['size'], row['md5'],
+                "%s@%s" % (row['consolidated'], row['data_offset']) if row['consolidated'] else "not consolidated",
+                "\t%s" % row['member'] if row.get('member') else ""))
+    else:
+        rows = [r for r in find(db, args.year, args.agency) if r['consolidated']]
+        if not rows:
+            sys.exit("No consolidated archive for %s in FY%s" % (args.agency, args.year))
+        for row in rows:
+            print(extract(args.root, row, args.dest))
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
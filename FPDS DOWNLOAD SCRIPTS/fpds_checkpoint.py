@@ -0,0 +1,162 @@
+# fpds_checkpoint
+###############################
+# Purpose: Lets fpds_dl.py pick a multi-year run back up after a crash or reboot.
+#          FPDS_run_state.json, next to the year folders, records the years and
+#          options of the run, each year's list of zip urls, and for each agency
+#          zip file which stages have finished: downloaded, verified, extracted
+#          and consolidated. It is rewritten atomically after every stage, so it
+#          always describes work that is really on disk. fpds_dl.py --resume
+#          reads it and skips whatever already finished.
+#
+# Usage:   python fpds_checkpoint.py D:\data\fpds\downloaded     (show where a run stopped)
+
+import os, sys, json, zipfile, argparse
+from datetime import datetime
+
+STATE_NAME = "FPDS_run_state.json"
+#stages of one agency zip file, in order
+STAGES = ('downloaded', 'verified', 'extracted', 'consolidated')
+
+
+def now():
+    return datetime.now().isoformat(timespec='seconds')
+
+
+class Checkpoint:
+    """State of one run of fpds_dl.py, saved after each stage.
+
+    Arg:
+            root: Folder containing the year folders, where the state file is kept.
+    """
+
+    def __init__(self, root):
+        self.path = os.path.join(root, STATE_NAME)
+        self.state = None
+        #open log file written to disk before each save, so the log never records less than the state
+        self.logfile = None
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.state = json.load(f)
+
+    def resumable(self):
+        """Whether there is a run that has not finished."""
+        return self.state is not None and not self.state['finished']
+
+    def start(self, years, options):
+        """Starts a new run, replacing the state of any earlier one."""
+        self.state = {'created': now(), 'updated': now(), 'finished': False, 'years': list(years),
+            'options': options, 'progress': {}}
+        self.save()
+
+    def save(self):
+        """Writes the state to a temporary file and moves it into place, so a crash never leaves it half written."""
+        self.state['updated'] = now()
+        if self.logfile is not None:
+            self.logfile.flush()
+            os.fsync(self.logfile.fileno())
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self.state, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def year(self, year):
+        """State of one year: its zip urls, its archives' stages and whether it is done."""
+        return self.state['progress'].setdefault(str(year), {'links': None, 'zip_urls': None, 'archives': {}, 'done': False})
+
+    def started(self, year):
+        return str(year) in self.state['progress']
+
+    def record_listing(self, year, links, zip_urls):
+        """Keeps a year's agency IDs and zip urls, so a resumed run does not fetch the directory again."""
+        state = self.year(year)
+        state['links'], state['zip_urls'] = links, zip_urls
+        self.save()
+
+    def archive(self, year, name):
+        return self.year(year)['archives'].setdefault(name, {})
+
+    def has(self, year, name, stage):
+        return stage in self.year(year)['archives'].get(name, {})
+
+    def mark(self, year, name, stage, **info):
+        """Records that a stage finished for one agency zip file, with anything learned doing it."""
+        archive = self.archive(year, name)
+        archive[stage] = now()
+        archive.update(info)
+        self.save()
+
+    def clear(self, year, name, *stages):
+        """Forgets stages of one agency zip file that must be done again."""
+        archive = self.archive(year, name)
+        for stage in stages:
+            archive.pop(stage, None)
+        self.save()
+
+    def mark_all(self, year, names, stage):
+        """Records that a stage finished for several agency zip files at once."""
+        for name in names:
+            self.archive(year, name)[stage] = now()
+        self.save()
+
+    def done(self, year):
+        """Whether every stage of a year finished."""
+        return self.started(year) and self.year(year)['done']
+
+    def finish_year(self, year):
+        self.year(year)['done'] = True
+        self.save()
+
+    def finish(self):
+        self.state['finished'] = True
+        self.save()
+
+
+def verify_archive(file_name_and_path, full=False):
+    """Checks that a downloaded agency zip file is whole.
+
+    Arg:
+            file_name_and_path: Path of the zip file.
+            full: Also check every member's CRC-32, for files joined from two downloads.
+    Returns:
+            None if the zip file is whole, otherwise why not.
+    """
+    try:
+        with zipfile.ZipFile(file_name_and_path, allowZip64=True) as z:
+            if full:
+                bad = z.testzip()
+                if bad is not None:
+                    return "bad CRC-32 for %s" % bad
+    except (OSError, EOFError, zipfile.error) as e:
+        return str(e)
+    return None
+
+
+def describe(checkpoint):
+    """Prints where a run stopped."""
+    state = checkpoint.state
+    print("Run of %s, started %s, last saved %s: %s" % ("-".join(str(y) for y in state['years'][::max(len(state['years'])-1, 1)]),
+        state['created'], state['updated'], "finished" if state['finished'] else "not finished"))
+    print("Options: %s" % ", ".join("%s=%s" % item for item in sorted(state['options'].items())))
+    for year in state['years']:
+        if not checkpoint.started(year):
+            print("FY%s\tnot started" % year)
+            continue
+        progress = checkpoint.year(year)
+        counts = [sum(1 for a in progress['archives'].values() if stage in a) for stage in STAGES]
+        print("FY%s\t%s\t%s zip files\t%s" % (year, "done" if progress['done'] else "in progress",
+            len(progress['zip_urls'] or []), "\t".join("%s %s" % item for item in zip(STAGES, counts))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show where an fpds_dl.py run stopped.")
+    parser.add_argument("root", help="folder containing the FPDS_FYyyyy year folders")
+    args = parser.parse_args()
+    checkpoint = Checkpoint(args.root)
+    if checkpoint.state is None:
+        sys.exit("No run state in %s" % args.root)
+    describe(checkpoint)
+
+
+if __name__ == "__main__":
+    main()
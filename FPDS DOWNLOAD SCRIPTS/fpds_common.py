@@ -0,0 +1,484 @@
+# fpds_common
+###############################
+# Purpose: Helpers shared by the FPDS download scripts.
+#          Builds directory and zip urls, downloads an agency archive,
+#          unzips it and consolidates a year folder.
+#          Nothing here opens a dialog box or runs on import, so the
+#          benchmark and other tools can use the same code as fpds_dl.py.
+
+#import string and download libraries
+import io, zipfile, zlib, errno, struct, hashlib, subprocess, os, requests, re, time
+from datetime import datetime
+
+from fpds_inflate import member_chunks
+from fpds_manifest import file_hashes
+
+#root of the FPDS data downloads; the benchmark points this at a local mock server
+FPDS_URL = "https://www.fpds.gov/ddps/"
+#location of PKZip on a GAO Windows 7 tower
+PKZIP = r"C:\progra~1\PKWARE\PKZIPC\pkzipc.exe"
+#zip files at or above this size are handed to PKZip rather than Python's zipfile
+PYTHON_UNZIP_LIMIT = 50000000
+#bytes read from the server per chunk
+CHUNK_SIZE = 1024
+#seconds to wait for a server to connect or send more data
+TIMEOUT = 300
+#bytes copied at a time when rewriting the consolidated zip file
+COPY_SIZE = 1048576
+#saved end of the consolidated zip file while an archive is appended to it
+JOURNAL_SUFFIX = ".journal"
+
+
+def dtime(path=""):
+    """Gets current time or date modified time.
+
+    If no path is provided, returns current time. If path is provided, returns time the file was modified.
+
+    Arg:
+            path: The path of the file you want to get the date modified.
+    Returns:
+            Current time or date modified time in the format 'mm/dd/yyyy H:M:S AM/PM'.
+    """
+    if path=="":
+        return (datetime.now().strftime('%m/%d/%Y %I:%M:%S %p'))
+    else:
+        return (datetime.fromtimestamp(int(os.stat(path).st_mtime)).strftime('%m/%d/%Y %I:%M:%S %p'))
+
+
+def find_id(html_string, logfile):
+    """Obtains agency IDs to be used for scraping FPDS zip files.
+
+    This pulls out all elements called "id" and writes them to an array
+    by using regular expresions (it takes everything between 'id="4' and '">').
+
+    Arg:
+            html_string: A string of html from the FPDS direcotry for a particular Fiscal Year.
+            logfile: Open log file that a mismatch between IDs and folders is written to.
+    Returns:
+            A list of agency IDs to be used in creating zipfile urls.
+    """
+
+    IDs = re.findall("id=\"4(.*?)\">",html_string)
+    foldergifs = re.findall("images/folder.gif",html_string)
+    #check to see if the regular expression captured all of the IDs
+    if len(IDs) != len(foldergifs): #if the # of IDs found does not match the number of folder.gif pictures
+         logfile.write('All IDs not found. Check html directory. Found %s IDs and %s foldergifs' % (len(IDs), len(foldergifs)))
+         print('All IDs not found. Check html directory. Found %s IDs and %s foldergifs' % (len(IDs), len(foldergifs)))
+    return IDs
+
+
+def find_directory(year, base_url=None):
+    """Finds the FPDS directory page and zip url prefix for a Fiscal Year.
+
+    FY16 directory is formatted different from other years it seprates with a _ instead of a -
+    so this pulls the folder name directly from the home directory with all years using regex.
+
+    Arg:
+            year: The Fiscal Year you want to download.
+            base_url: Root of the FPDS data downloads; FPDS_URL, as it is when called, if None.
+    Returns:
+            A tuple of the directory url for the year and the prefix used to build zip urls.
+    """
+    base_url = base_url or FPDS_URL
+    yy = str(year)[-2:]
+    directory_all = requests.get(base_url + "directory_browser/index.php?somepath=")
+    directory_year = re.findall("a href=\"(.*?)\">",directory_all.text)
+    #From the list of directory links, find the directory for the input year
+    regex = re.compile(".*(%s).*" % yy)
+    directory_end = [m.group(0) for l in directory_year for m in [regex.search(l)] if m][0]
+    #example: https://www.fpds.gov/ddps/directory_browser/index.php?somepath=..%2FFY13-V1.4&n=2
+    directory_url = base_url + "directory_browser/index.php%s" % directory_end
+    #prefix we use to build the urls for the zip files
+    prefend = re.findall("%2(.*?)&n=2",directory_end)[0][1:]
+    pref = base_url + "%s/" % prefend
+    return directory_url, pref
+
+
+def archive_suffix(year):
+    """Gets the end of the zip file names for a Fiscal Year.
+
+    Arg:
+            year: The Fiscal Year you want to download.
+    Returns:
+            The suffix that follows the agency ID in each zip file name.
+    """
+    if 2003 < year < 2015:
+        return "-DEPTOctober" + str(year-1) + "-Archive.zip"
+    #after 2015, the suffix is different
+    elif 2015<= year <= datetime.now().year:
+        return "-DEPT-1001" + str(year-1) + "TO0930" + str(year) + "-Archive.zip"
+    raise ValueError('%s Year out of bounds' % year)
+
+
+def archive_urls(links, pref, suf):
+    """Builds the zip file url for each agency ID.
+
+    Arg:
+            links: Agency IDs from find_id.
+            pref: Zip url prefix from find_directory.
+            suf: Zip file name suffix from archive_suffix.
+    Returns:
+            A list of zip file urls in the same order as links.
+    """
+    zip_urls=[]
+    for l in links:
+        if l == 'OTHER_DOD_AGENCIES': #special case for OTHER DOD. Second ID is DOD-OTHER_DOD
+            u = pref + l + "/DOD-OTHER_DOD" + suf
+        else:
+            u = pref + l + "/" + l + suf #url contains the agency ID twice
+        zip_urls.append(u)
+    return zip_urls
+
+
+def download_archive(u, PATH, logfile, chunk_size=CHUNK_SIZE, telemetry=None, resume=False):
+    """Downloads one agency zip file into a year folder.
+
+    The file is hashed (md5 and sha256) as it is written, and its date modified, size and md5 are logged.
+    With resume, a file partly downloaded by an earlier run is continued from where it stopped with
+    a Range request; if the server does not serve ranges it is downloaded again from the start.
+
+    Arg:
+            u: Url of the zip file.
+            PATH: Year folder to save the zip file in.
+            logfile: Open log file.
+            chunk_size: Bytes read from the server per chunk.
+            telemetry: fpds_telemetry.Telemetry to count the file's bytes in, or None.
+            resume: Continue a partly downloaded file rather than starting over.
+    Returns:
+            A tuple of the saved file's path, whether the server returned it, and a dict of its
+            'md5' and 'sha256' hex digests (None if not hashed).
+    """
+    fname = re.search("([^/]+$)",u).group(0)
+    file_name_and_path = os.path.join(PATH, fname)
+    offset = os.stat(file_name_and_path).st_size if resume and os.path.isfile(file_name_and_path) else 0
+    request = None
+    #try the request a second time before giving up on this file
+    for attempt in range(2):
+        try:
+            request = requests.get(u, stream=True, headers={'Range': "bytes=%s-" % offset} if offset else None, timeout=TIMEOUT)
+            if offset and request.status_code == 416 and request.headers.get('Content-Range') != "bytes */%s" % offset:
+                #the file on the server is smaller than the part already saved, so it is not the same file
+                request.close()
+                offset = 0
+                request = requests.get(u, stream=True, timeout=TIMEOUT)
+            break
+        except requests.exceptions.RequestException as e:
+            logfile.write("Can't retrieve %s: %s\n" % (u, e))
+            print("Can't retrieve %s: %s" % (u, e))
+            if telemetry and attempt == 0:
+                telemetry.retry(u)
+    if request is None:
+        if telemetry:
+            telemetry.finish(u, False)
+        return file_name_and_path, False, None
+    if offset and request.status_code == 416:
+        #the earlier run saved the whole file but stopped before recording it
+        request.close()
+        with open(file_name_and_path, 'rb') as zip_file:
+            hashes = file_hashes(zip_file)
+        logfile.write("[%s] Saved %s\t%s bytes. md5: %s (downloaded by an earlier run)\n" % (dtime(file_name_and_path), fname, offset, hashes['md5']))
+        if telemetry:
+            telemetry.finish(u, True)
+        return file_name_and_path, True, hashes
+    if offset and request.status_code not in (200, 206):
+        #keep the part already saved for the next try
+        logfile.write("%s Can't retrieve %s\n" % (request.status_code, u))
+        print("%s Can't retrieve %s" % (request.status_code, u))
+        request.close()
+        if telemetry:
+            telemetry.finish(u, False)
+        return file_name_and_path, False, None
+    if request.status_code != 206:
+        offset = 0
+    retrieved = request.status_code in (200, 206)
+    if not retrieved:
+        logfile.write("%s Can't retrieve %s\n" % (request.status_code, u))
+        print("%s Can't retrieve %s" % (request.status_code, u))
+    elif offset:
+        logfile.write("[%s] Resuming %s at byte %s\n" % (dtime(), fname, offset))
+    hashes = None
+    progress = telemetry.start(u, int(request.headers.get('Content-Length', 0)) or None) if telemetry else None
+    try:
+        # Initilize md5 and sha256 hash keys
+        hash_md5 = hashlib.md5()
+        hash_sha256 = hashlib.sha256()
+        hash_all_updated = True
+        if offset:
+            #the hashes cover the part saved by the earlier run too
+            with open(file_name_and_path, "rb") as saved:
+                for chunk in iter(lambda: saved.read(COPY_SIZE), b""):
+                    hash_md5.update(chunk)
+                    hash_sha256.update(chunk)
+        with open(file_name_and_path, "ab" if offset else "wb+") as zip_file:
+            # Write the contents of the downloaded file chunk by chunk into the new file
+            for chunk in request.iter_content(chunk_size=chunk_size):
+                if chunk: # filter out keep-alive new chunks
+                    zip_file.write(chunk)
+                    if progress is not None:
+                        progress.done += len(chunk)
+                    #add data to hash key
+                    try:
+                        hash_md5.update(chunk)
+                        hash_sha256.update(chunk)
+                    except:
+                        hash_all_updated = False
+        #if every chunk was captured in the hash output the hash key
+        if hash_all_updated:
+            hashes = {'md5': hash_md5.hexdigest(), 'sha256': hash_sha256.hexdigest()}
+            hash_text = " md5: %s" % hashes['md5']
+        else: hash_text = "hash not updated succesfully"
+        #record information about the file we are currently reading
+        logfile.write("[%s] Saved %s\t%s bytes. %s\n" % (dtime(file_name_and_path), fname, os.stat(file_name_and_path).st_size, hash_text))
+    except:
+        #the connection dropped or timed out part way; what was saved is kept for resuming
+        logfile.write("File %s not saved\n" % u)
+        retrieved = False
+    if telemetry:
+        telemetry.finish(u, retrieved and hashes is not None)
+    return file_name_and_path, retrieved, hashes
+
+
+def run_pkzip(args, PATH, logfile):
+    """Runs PKZip and logs its output.
+
+    Arg:
+            args: Arguments passed to pkzipc.exe.
+            PATH: Folder PKZip runs in, so that unzipped files land in the right place.
+            logfile: Open log file.
+    Returns:
+            Nothing.
+    """
+    subprocess_results= ""
+    try:
+        subprocess_results = subprocess.check_output([PKZIP] + args, stderr=subprocess.STDOUT, cwd=PATH)
+        logfile.write(repr(subprocess_results)+"\n")
+    except subprocess.CalledProcessError as e:
+        print(repr(e.returncode))
+        print(repr(e.cmd))
+        print(repr(e.output))
+    except Exception as e:
+        print(repr(e))
+
+
+def extract_archive(file_name_and_path, u, PATH, logfile, unzip_limit=PYTHON_UNZIP_LIMIT, backend=None):
+    """Unzips one agency zip file into a year folder.
+
+    Checks that the zip file contains an IDV and AWARD file. Zip files under unzip_limit are
+    unzipped member by member with Python, keeping each member's date modified; larger zip
+    files tend to be slightly invalid in ways that Python's ZIP library cannot handle, so they
+    are handed to PKZip in one operation.
+
+    Arg:
+            file_name_and_path: Path of the downloaded zip file.
+            u: Url the zip file came from, used in the log.
+            PATH: Year folder to unzip into.
+            logfile: Open log file.
+            unzip_limit: Zip file size at which PKZip is used instead. None always uses Python.
+            backend: Inflate backend from fpds_inflate.BACKENDS; the fastest installed if None.
+    Returns:
+            A list with a dict for each file member: its 'name', 'size', zip 'crc', 'mtime' (seconds since
+            the epoch), whether it was 'unzipped' with Python, and if so its 'md5' and 'sha256'.
+    """
+    fname = os.path.basename(file_name_and_path)
+    members = []
+    use_python = unzip_limit is None or os.stat(file_name_and_path).st_size < unzip_limit
+    #open recently downloaded zip file
+    with open(file_name_and_path, 'rb') as fileobj:
+        try:
+            filezip = zipfile.ZipFile(fileobj, allowZip64=True)
+            idv = False
+            award = False
+            for member in filezip.infolist():
+                #check IDV files and AWARD files exist in the zip file
+                kind = re.search("-[^-]*.xml$",member.filename)
+                if kind and kind.group(0) == "-IDV.xml": idv=True
+                if kind and kind.group(0) == "-AWARD.xml": award=True
+                date_time = time.mktime(member.date_time + (0, 0, -1))
+                record = {'name': member.filename, 'size': member.file_size, 'crc': member.CRC,
+                    'mtime': date_time, 'unzipped': False, 'md5': None, 'sha256': None}
+                if not member.is_dir():
+                    members.append(record)
+
+                #only unzip the current member with Python if the ZIP file is small enough that Python should work
+                if use_python:
+                    try:
+                        target_path = os.path.join(PATH, member.filename)
+                        if target_path.endswith('/'):  # folder entry, create
+                            try:
+                                os.makedirs(target_path)
+                            except (OSError, IOError) as err:
+                                # Ignore Windows error if the folders already exist
+                                if err.errno != errno.EEXIST:
+                                    raise
+                            continue
+                        hash_md5 = hashlib.md5()
+                        hash_sha256 = hashlib.sha256()
+                        with open(target_path, 'wb') as outfile:
+                            #hash each member as it is written rather than reading it back afterwards
+                            for chunk in member_chunks(filezip, fileobj, member, backend):
+                                outfile.write(chunk)
+                                hash_md5.update(chunk)
+                                hash_sha256.update(chunk)
+                        #Preserve file modified time by manually changing it
+                        os.utime(target_path, (date_time, date_time))
+                        file_time = datetime(*member.date_time).strftime('%Y-%m-%d %H:%M:%S')
+                        #Log file name, file size, and file modified time, for files unzipped
+                        logfile.write("%s %s bytes.\tDate modified: %s\n" % (member.filename, member.file_size, file_time))
+                        record.update(unzipped=True, md5=hash_md5.hexdigest(), sha256=hash_sha256.hexdigest())
+                    except (zipfile.error, zlib.error, EOFError) as e:
+                        logfile.write('%s did not unzip correctly.: %s\n' % (member, e))
+            #Log missing file (IDV or AWARD)
+            if not (idv and award):
+                logfile.write("Missing %s %s for %s\n" % ("IDV.xml"*(not idv), "AWARD.xml"*(not award), fname))
+            #if zip file size greater than or equal to 50mb, shell out to PKZIP to extract everything in one operation
+            #we do so outside the loop.
+            #THIS DOES NOT WORK ON VDI BECAUSE OUR PKZIP LICENSE DOES NOT
+            #ALLOW "SERVER" INSTALLATIONS, AND APPARENTLY CALLING IT FROM CITRIX LOOKS LIKE A SERVER INSTALLATION TO IT
+            if not use_python:
+                run_pkzip(["-extract", file_name_and_path], PATH, logfile)
+        except zipfile.error as e:
+            logfile.write('%s is not a zip file. (url=%s): %s\n' % (fileobj, u, e))
+    return members
+
+
+def consolidate(PATH, logfile):
+    """Moves every zip file in a year folder into one consolidated PATH.zip with PKZip.
+
+    Arg:
+            PATH: Year folder.
+            logfile: Open log file.
+    Returns:
+            Nothing.
+    """
+    run_pkzip(["-add", "-store", "-move", PATH +".zip", os.path.join(PATH, "*.zip")], PATH, logfile)
+
+
+def consolidate_archive(file_name_and_path, PATH, logfile):
+    """Moves one agency zip file into the consolidated PATH.zip as soon as it has been unzipped.
+
+    This appends to PATH.zip in place with Python's zipfile, storing without compression like
+    consolidate does. PKZip rewrites the whole consolidated zip file each time something is
+    added to it, which would need room for two copies of it.
+
+    Arg:
+            file_name_and_path: Path of the agency zip file, which is deleted once it is copied.
+            PATH: Year folder.
+            logfile: Open log file.
+    Returns:
+            Nothing.
+    """
+    fname = os.path.basename(file_name_and_path)
+    journal_consolidated(PATH, fname)
+    with zipfile.ZipFile(PATH + ".zip", 'a', zipfile.ZIP_STORED, allowZip64=True) as consolidated:
+        consolidated.write(file_name_and_path, fname)
+    os.remove(PATH + ".zip" + JOURNAL_SUFFIX)
+    os.remove(file_name_and_path)
+    logfile.write("[%s] Moved %s into %s\n" % (dtime(), fname, os.path.basename(PATH) + ".zip"))
+
+
+def consolidated_names(PATH):
+    """Names of the agency zip files already in the consolidated PATH.zip."""
+    if not os.path.isfile(PATH + ".zip"):
+        return set()
+    with zipfile.ZipFile(PATH + ".zip", allowZip64=True) as consolidated:
+        return set(consolidated.namelist())
+
+
+def journal_consolidated(PATH, fname):
+    """Saves the end of the consolidated PATH.zip before fname is appended to it.
+
+    Appending writes over the central directory at the end of the zip file and writes a new one
+    after the added file, so a crash part way through leaves a zip file without one.
+    recover_consolidated puts the saved end back.
+    """
+    consolidated = PATH + ".zip"
+    if os.path.isfile(consolidated):
+        with zipfile.ZipFile(consolidated, allowZip64=True) as z:
+            #where the central directory starts, which is where appending begins
+            start = z.start_dir
+        with open(consolidated, 'rb') as f:
+            f.seek(start)
+            tail = f.read()
+    else:
+        start, tail = -1, b""
+    with open(consolidated + JOURNAL_SUFFIX + ".tmp", 'wb') as journal:
+        name = fname.encode()
+        journal.write(struct.pack("<qH", start, len(name)) + name + tail)
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(consolidated + JOURNAL_SUFFIX + ".tmp", consolidated + JOURNAL_SUFFIX)
+
+
+def recover_consolidated(PATH, logfile):
+    """Repairs the consolidated PATH.zip if a run stopped while appending to it.
+
+    Returns:
+            True if the zip file had to be put back as it was before the append.
+    """
+    consolidated = PATH + ".zip"
+    journal_path = consolidated + JOURNAL_SUFFIX
+    if not os.path.isfile(journal_path):
+        return False
+    with open(journal_path, 'rb') as journal:
+        start, length = struct.unpack("<qH", journal.read(10))
+        fname = journal.read(length).decode()
+        tail = journal.read()
+    names = {fname}
+    if tail:
+        with zipfile.ZipFile(io.BytesIO(tail)) as before:
+            names.update(before.namelist())
+    try:
+        #a broken PATH.zip can still seem to open, on the end of an agency zip file stored inside it
+        with zipfile.ZipFile(consolidated, allowZip64=True) as z:
+            if names <= set(z.namelist()):
+                #the append finished; only removing the journal was left
+                os.remove(journal_path)
+                return False
+    except (OSError, zipfile.error):
+        pass
+    if start < 0:
+        if os.path.isfile(consolidated):
+            os.remove(consolidated)
+    else:
+        with open(consolidated, 'r+b') as f:
+            f.truncate(start)
+            f.seek(start)
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+    os.remove(journal_path)
+    logfile.write("[%s] %s was left half written by an earlier run; restored it to before the last append\n" % (dtime(), os.path.basename(consolidated)))
+    return True
+
+
+def remove_from_consolidated(names, PATH, logfile):
+    """Drops agency zip files from the consolidated PATH.zip, so newer copies can be added.
+
+    Zip files cannot delete in place, so the other entries are copied into a new consolidated
+    zip file that then replaces the old one. They are stored without compression, so this is
+    a plain copy.
+
+    Arg:
+            names: File names of the agency zip files to drop.
+            PATH: Year folder.
+            logfile: Open log file.
+    Returns:
+            The names that were dropped.
+    """
+    consolidated = PATH + ".zip"
+    if not os.path.isfile(consolidated):
+        return []
+    with zipfile.ZipFile(consolidated, allowZip64=True) as old:
+        dropped = [info.filename for info in old.infolist() if info.filename in names]
+        if not dropped:
+            return []
+        with zipfile.ZipFile(consolidated + ".tmp", 'w', zipfile.ZIP_STORED, allowZip64=True) as new:
+            for info in old.infolist():
+                if info.filename in dropped:
+                    continue
+                with old.open(info) as src, new.open(info, 'w', force_zip64=True) as dst:
+                    for chunk in iter(lambda: src.read(COPY_SIZE), b""):
+                        dst.write(chunk)
+    os.replace(consolidated + ".tmp", consolidated)
+    logfile.write("[%s] Removed %s from %s\n" % (dtime(), ", ".join(dropped), os.path.basename(consolidated)))
+    return dropped
@@ -0,0 +1,422 @@
+# fpds_coordinator
+###############################
+# Purpose: Splits an FPDS download across several machines or processes.
+#          Every (fiscal year, agency zip file) is a job in a SQLite ledger on
+#          a shared path. Workers lease one job at a time, keep the lease alive
+#          with heartbeats while they download and unzip it, and a job whose
+#          lease runs out (the worker died or hung) is handed to another worker.
+#          Each worker writes its own log and manifest part into the year folder;
+#          merge combines them into the FPDS_DL_log_file.log and manifest that
+#          fpds_dl.py would have written, and consolidates the year. Each worker's
+#          progress is written to FPDS_status.<worker>.json in root.
+#
+# Usage:   python fpds_coordinator.py plan  \\share\fpds \\share\fpds\FPDS_jobs.sqlite 2006-2016
+#          python fpds_coordinator.py work  \\share\fpds \\share\fpds\FPDS_jobs.sqlite    (on each machine)
+#          python fpds_coordinator.py merge \\share\fpds \\share\fpds\FPDS_jobs.sqlite
+#          python fpds_coordinator.py local D:\fpds 2006-2008 --workers 4               (all of the above in one machine)
+
+import os, re, json, glob, time, socket, sqlite3, argparse, threading, multiprocessing, requests
+
+import fpds_common
+from fpds_common import dtime, find_id, find_directory, archive_suffix, archive_urls, download_archive, extract_archive, consolidate_archive
+from fpds_manifest import load_manifest, save_manifest, add_archive, MANIFEST_PART_NAME
+import fpds_catalog
+from fpds_telemetry import Telemetry, STATUS_PART_NAME
+
+#seconds a lease lasts without a heartbeat
+LEASE = 600
+#attempts at a job before it is marked failed
+MAX_ATTEMPTS = 3
+#seconds a worker waits before asking again when every remaining job is leased to someone else
+POLL = 30
+#log written by one worker, merged into FPDS_DL_log_file.log
+LOG_PART_NAME = "FPDS_DL_log_file.%s.log"
+#folder in the year folder one worker downloads into, so a worker that lost its lease writes only its own files
+DOWNLOAD_PART_NAME = "FPDS_download.%s"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    year INTEGER NOT NULL,
+    url TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    heartbeat REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    md5 TEXT,
+    error TEXT,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+"""
+
+
+def connect(ledger):
+    """Opens the job ledger, creating it if needed.
+
+    Transactions are begun explicitly so that claiming a job can take the write lock up front.
+    The default rollback journal is kept because SQLite's WAL mode does not work on network shares.
+    """
+    db = sqlite3.connect(ledger, timeout=120, isolation_level=None)
+    db.executescript(SCHEMA)
+    return db
+
+
+def year_path(root, year):
+    """Year folder, named like fpds_dl.py names it."""
+    return os.path.normpath(os.path.join(root, "FPDS_FY%s" % year))
+
+
+def worker_name():
+    """Name of this worker: host name and process ID."""
+    return "%s-%s" % (re.sub(r"[^A-Za-z0-9_]", "_", socket.gethostname()), os.getpid())
+
+
+def plan(root, ledger, years, base_url=None):
+    """Adds a job for every agency zip file of the given years to the ledger.
+
+    The directory of each year is saved in its year folder and logged, as fpds_dl.py does.
+    Jobs already in the ledger are left as they are, so planning again is safe.
+
+    Arg:
+            root: Folder the FPDS_FYyyyy year folders are created in.
+            ledger: Path of the SQLite job ledger.
+            years: Fiscal Years to download.
+            base_url: Root of the FPDS data downloads; fpds_common.FPDS_URL if None.
+    Returns:
+            The number of jobs added.
+    """
+    os.makedirs(root, exist_ok=True)
+    db = connect(ledger)
+    added = 0
+    for year in years:
+        PATH = year_path(root, year)
+        os.makedirs(PATH, exist_ok=True)
+        with open(os.path.join(PATH, LOG_PART_NAME % "coordinator"), 'a') as logfile:
+            logfile.write("[%s] fpds_coordinator.py planned run\n" % dtime())
+            directory_url, pref = find_directory(year, base_url)
+            f = requests.get(directory_url)
+            path_directory = os.path.join(PATH, "FPDS_directory_FY%s.html" % year)
+            with open(path_directory, "w") as directory:
+                directory.write(f.text)
+            logfile.write("[%s] Saved directory of FPDS for FY %s\n" %(dtime(), year))
+            links = find_id(f.text, logfile)
+            logfile.write("Agency IDs obtained: %r\n" % links)
+            logfile.write("Zip urls attempted to downloaded:\n")
+            zip_urls = archive_urls(links, pref, archive_suffix(year))
+            for u in zip_urls:
+                logfile.write(u+"\n")
+                added += db.execute("INSERT OR IGNORE INTO jobs (year, url) VALUES (?, ?)", (year, u)).rowcount
+    db.close()
+    return added
+
+
+def claim(db, worker, lease=LEASE):
+    """Leases the next job that is pending, or whose lease has run out.
+
+    Returns:
+            A tuple of (id, year, url, previous worker) or None if no job can be leased now.
+    """
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute("SELECT id, year, url, worker FROM jobs WHERE (status = 'pending' OR "
+            "(status = 'leased' AND lease_expires < ?)) AND attempts < ? ORDER BY year, id LIMIT 1",
+            (now, MAX_ATTEMPTS)).fetchone()
+        if row:
+            db.execute("UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, heartbeat = ?, "
+                "attempts = attempts + 1 WHERE id = ?", (worker, now + lease, now, row[0]))
+        db.execute("COMMIT")
+    except:
+        db.execute("ROLLBACK")
+        raise
+    return row
+
+
+def finish(db, job_id, worker, md5=None, error=None):
+    """Marks a leased job done, or failed so another worker can retry it.
+
+    Returns:
+            False if the job's lease had already been handed to another worker.
+    """
+    if error is None:
+        return db.execute("UPDATE jobs SET status = 'done', md5 = ?, error = NULL, finished = ? "
+            "WHERE id = ? AND worker = ? AND status = 'leased'", (md5, time.time(), job_id, worker)).rowcount == 1
+    return db.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+        "error = ?, lease_expires = NULL WHERE id = ? AND worker = ? AND status = 'leased'",
+        (MAX_ATTEMPTS, error, job_id, worker)).rowcount == 1
+
+
+class Heartbeat(threading.Thread):
+    """Extends the lease on a job every third of the lease until stopped.
+
+    Given the telemetry the job's download is counted in, the lease is only extended while the
+    download is receiving bytes (or is over), so a transfer that hangs loses its lease and the
+    job is handed to another worker.
+    """
+
+    def __init__(self, ledger, job_id, worker, lease=LEASE, telemetry=None, u=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.ledger, self.job_id, self.worker, self.lease = ledger, job_id, worker, lease
+        self.telemetry, self.u = telemetry, u
+        self.stopped = threading.Event()
+        self.lost = False
+        self._bytes = None
+
+    def moving(self):
+        """Whether the job's download got more bytes since the last heartbeat, or is not running."""
+        if self.telemetry is None:
+            return True
+        with self.telemetry.lock:
+            progress = self.telemetry.active.get(self.u)
+            done = progress and progress.done
+        if progress is None:
+            return True
+        moved, self._bytes = done != self._bytes, done
+        return moved
+
+    def held(self):
+        """Checks the ledger for whether the job is still leased to this worker, setting lost if not.
+
+        A lease that ran out is still held until another worker claims the job.
+        """
+        db = connect(self.ledger)
+        try:
+            if db.execute("SELECT COUNT(*) FROM jobs WHERE id = ? AND worker = ? AND status = 'leased'",
+                    (self.job_id, self.worker)).fetchone()[0] != 1:
+                self.lost = True
+        finally:
+            db.close()
+        return not self.lost
+
+    def run(self):
+        db = connect(self.ledger)
+        while not self.stopped.wait(self.lease/3):
+            if not self.moving():
+                #stalled; let the lease run out
+                continue
+            now = time.time()
+            if db.execute("UPDATE jobs SET heartbeat = ?, lease_expires = ? WHERE id = ? AND worker = ? "
+                    "AND status = 'leased'", (now, now + self.lease, self.job_id, self.worker)).rowcount != 1:
+                self.lost = True
+                break
+        db.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(root, year, u, worker, logfile, telemetry=None, heartbeat=None):
+    """Downloads and unzips one agency zip file and adds it to this worker's manifest part.
+
+    The zip file is downloaded into this worker's own folder and only moved into the year folder
+    if the lease is still held, so a slow worker whose job was taken over never writes into the
+    file the new worker is downloading.
+
+    Returns:
+            The zip file's md5.
+    Raises:
+            IOError: if the server did not return the file, or the job's lease was handed to
+                     another worker, which is now writing the same files.
+    """
+    PATH = year_path(root, year)
+    part = os.path.join(PATH, DOWNLOAD_PART_NAME % worker)
+    os.makedirs(part, exist_ok=True)
+    part_file, retrieved, hashes = download_archive(u, part, logfile, telemetry=telemetry)
+    file_name_and_path = os.path.join(PATH, os.path.basename(part_file))
+    try:
+        if not retrieved or not os.path.isfile(part_file):
+            raise IOError("Can't retrieve %s" % u)
+        if heartbeat and not heartbeat.held():
+            raise IOError("Lease on %s was lost" % u)
+        os.replace(part_file, file_name_and_path)
+    finally:
+        if os.path.isfile(part_file):
+            os.remove(part_file)
+        if not os.listdir(part):
+            os.rmdir(part)
+    members = extract_archive(file_name_and_path, u, PATH, logfile)
+    if heartbeat and not heartbeat.held():
+        raise IOError("Lease on %s was lost" % u)
+    manifest = load_manifest(PATH, year, worker)
+    add_archive(manifest, file_name_and_path, u, hashes, members, PATH)
+    save_manifest(manifest, PATH, worker)
+    return hashes and hashes['md5']
+
+
+def work(root, ledger, worker=None, lease=LEASE, poll=POLL):
+    """Leases and runs jobs until none are left.
+
+    A worker keeps waiting while other workers hold leases, so that it can take over any
+    job whose worker stops sending heartbeats.
+
+    Arg:
+            root: Folder containing the year folders.
+            ledger: Path of the SQLite job ledger.
+            worker: Name of this worker; defaults to host name and process ID.
+            lease: Seconds a lease lasts without a heartbeat.
+            poll: Seconds to wait when every remaining job is leased to someone else.
+    Returns:
+            The number of jobs this worker finished.
+    """
+    worker = worker or worker_name()
+    db = connect(ledger)
+    logs = {}
+    done = 0
+    telemetry = Telemetry(os.path.join(root, STATUS_PART_NAME % worker))
+    try:
+        while True:
+            job = claim(db, worker, lease)
+            if job is None:
+                if db.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'leased') "
+                        "AND attempts < ?", (MAX_ATTEMPTS,)).fetchone()[0] == 0:
+                    break
+                time.sleep(poll)
+                continue
+            job_id, year, u, previous = job
+            if year not in logs:
+                logs[year] = open(os.path.join(year_path(root, year), LOG_PART_NAME % worker), 'a')
+            logfile = logs[year]
+            if previous and previous != worker:
+                logfile.write("[%s] %s taken over from %s after its lease ran out\n" % (dtime(), u, previous))
+            heartbeat = Heartbeat(ledger, job_id, worker, lease, telemetry, u)
+            heartbeat.start()
+            telemetry.plan(year, [u])
+            telemetry.stage = "job %s" % job_id
+            try:
+                md5 = run_job(root, year, u, worker, logfile, telemetry, heartbeat)
+                error = None
+            except Exception as e:
+                md5, error = None, repr(e)
+                logfile.write("[%s] %s failed: %s\n" % (dtime(), u, error))
+            finally:
+                heartbeat.stop()
+            logfile.flush()
+            if not finish(db, job_id, worker, md5, error):
+                logfile.write("[%s] Lease on %s was lost before it finished\n" % (dtime(), u))
+                #give the worker that took it over time to finish before asking for more
+                time.sleep(poll)
+            elif error is None:
+                done += 1
+    finally:
+        for logfile in logs.values():
+            logfile.close()
+        db.close()
+        telemetry.close()
+    return done
+
+
+def merge(root, ledger):
+    """Combines the workers' logs and manifest parts for each year and consolidates it.
+
+    Arg:
+            root: Folder containing the year folders.
+            ledger: Path of the SQLite job ledger.
+    Returns:
+            A dict of year to (jobs, jobs done).
+    """
+    db = connect(ledger)
+    catalog = fpds_catalog.connect(root)
+    summary = {}
+    for year, jobs, finished in db.execute("SELECT year, COUNT(*), SUM(status = 'done') FROM jobs GROUP BY year ORDER BY year").fetchall():
+        PATH = year_path(root, year)
+        manifest = load_manifest(PATH, year)
+        for part in sorted(glob.glob(os.path.join(PATH, MANIFEST_PART_NAME % (year, "*")))):
+            with open(part) as f:
+                manifest['archives'].update(json.load(f)['archives'])
+            os.remove(part)
+        #the coordinator's part, with the directory and url list, goes first like in fpds_dl.py's log
+        parts = sorted(glob.glob(os.path.join(PATH, LOG_PART_NAME % "*")), key=lambda p: not p.endswith(LOG_PART_NAME % "coordinator"))
+        with open(os.path.join(PATH, "FPDS_DL_log_file.log"), 'a') as logfile:
+            for part in parts:
+                with open(part) as f:
+                    logfile.write(f.read())
+                os.remove(part)
+            for (error_url, error) in db.execute("SELECT url, error FROM jobs WHERE year = ? AND status != 'done'", (year,)):
+                logfile.write("ERROR: %s not downloaded: %s\n" % (error_url, error))
+            if jobs != finished:
+                logfile.write("ERROR: %s Download(s) missing\n" % (jobs-finished))
+            logfile.write("%s links found \t%s links downloaded\n" %(jobs, finished))
+            for name in sorted(manifest['archives']):
+                if os.path.isfile(os.path.join(PATH, name)):
+                    consolidate_archive(os.path.join(PATH, name), PATH, logfile)
+                    manifest['consolidated'] = os.path.basename(PATH) + ".zip"
+        save_manifest(manifest, PATH)
+        fpds_catalog.index_year(catalog, PATH, year)
+        summary[year] = (jobs, finished)
+        print("FY%s: %s links found \t%s links downloaded" % (year, jobs, finished))
+    catalog.close()
+    db.close()
+    return summary
+
+
+def status(ledger):
+    """Prints the number of jobs in each status for each year."""
+    db = connect(ledger)
+    for year, state, count, workers in db.execute("SELECT year, status, COUNT(*), COUNT(DISTINCT worker) FROM jobs "
+            "GROUP BY year, status ORDER BY year, status"):
+        print("FY%s\t%s\t%s jobs\t%s workers" % (year, state, count, workers))
+    db.close()
+
+
+def local(root, years, workers, base_url=None, lease=LEASE, poll=POLL):
+    """Runs plan, several worker processes and merge on this machine.
+
+    This stands in for a group of machines, for trying the coordinator out against the mock server.
+    """
+    os.makedirs(root, exist_ok=True)
+    ledger = os.path.join(root, "FPDS_jobs.sqlite")
+    plan(root, ledger, years, base_url)
+    processes = [multiprocessing.Process(target=work, args=(root, ledger, "local%s" % i, lease, poll)) for i in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    return merge(root, ledger)
+
+
+def year_range(text):
+    """Reads a Fiscal Year or year range such as 2006 or 2006-2016 or 6-16."""
+    ylist = [int(n) for n in text.split("-")]
+    ylist = [YEAR + 2000 if 0 < YEAR < 99 else YEAR for YEAR in ylist]
+    return list(range(ylist[0], ylist[-1]+1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split an FPDS download across several workers.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help in (("plan", "add the jobs for a year range to the ledger"), ("work", "run jobs until none are left"),
+            ("merge", "combine worker logs and manifests and consolidate each year"), ("status", "count jobs by status"),
+            ("local", "plan, run several worker processes and merge on this machine")):
+        command = commands.add_parser(name, help=help)
+        if name != "status":
+            command.add_argument("root", help="folder containing the FPDS_FYyyyy year folders")
+        if name != "local":
+            command.add_argument("ledger", help="SQLite job ledger on a path every worker can reach")
+        if name in ("plan", "local"):
+            command.add_argument("years", type=year_range, help="Fiscal Year or Year Range, e.g. 2006-2016")
+            command.add_argument("--base-url", default=fpds_common.FPDS_URL, help="root of the FPDS data downloads")
+        if name in ("work", "local"):
+            command.add_argument("--lease", type=float, default=LEASE, help="seconds a lease lasts without a heartbeat")
+            command.add_argument("--poll", type=float, default=POLL, help="seconds between asking for jobs when all are leased")
+        if name == "work":
+            command.add_argument("--worker", help="worker name (default: host name and process ID)")
+        if name == "local":
+            command.add_argument("--workers", type=int, default=4, help="worker processes")
+    args = parser.parse_args()
+    if args.command == "plan":
+        print("%s jobs added" % plan(args.root, args.ledger, args.years, args.base_url))
+    elif args.command == "work":
+        print("%s jobs done" % work(args.root, args.ledger, args.worker, args.lease, args.poll))
+    elif args.command == "merge":
+        merge(args.root, args.ledger)
+    elif args.command == "status":
+        status(args.ledger)
+    else:
+        local(args.root, args.years, args.workers, args.base_url, args.lease, args.poll)
+
+
+if __name__ == "__main__":
+    main()
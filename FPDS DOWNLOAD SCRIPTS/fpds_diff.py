@@ -0,0 +1,272 @@
+# fpds_diff
+###############################
+# Purpose: What changed on FPDS since a year was downloaded.
+#          When FPDS republishes a year (FY13-V1.4 becoming FY13-V1.5, say) the
+#          year's directory listing is parsed fresh and every agency zip file is
+#          asked for its size and date modified with a HEAD request. These are
+#          compared with the year folder's manifest, or for folders downloaded
+#          before manifests, with the saved FPDS_directory_FYyyyy.html. Added,
+#          removed and changed zip files are printed and can be saved as a change
+#          set; update downloads only those, so a republish costs only the
+#          changed bytes.
+#
+# Usage:   python fpds_diff.py diff D:\data\fpds\downloaded 2013
+#          python fpds_diff.py diff D:\data\fpds\downloaded 2006-2016 --json D:\temp\changes.json
+#          python fpds_diff.py update D:\data\fpds\downloaded 2013 --engine async
+#          python fpds_diff.py update D:\data\fpds\downloaded 2013 --changes D:\temp\changes.json
+
+import os, io, json, shutil, argparse, requests
+from datetime import datetime
+
+import fpds_common
+from fpds_common import dtime, find_id, find_directory, archive_suffix, archive_urls, download_archive, extract_archive, \
+    consolidate_archive, remove_from_consolidated
+from fpds_manifest import load_manifest, save_manifest, add_archive, manifest_path, MTIME_TOLERANCE
+from fpds_transport import make_transport, aiohttp
+from fpds_coordinator import year_path, year_range
+from fpds_checkpoint import verify_archive
+import fpds_catalog
+
+DIRECTORY_NAME = "FPDS_directory_FY%s.html"
+#folder in the year folder that new copies are downloaded into until they are checked
+STAGING_NAME = "FPDS_update"
+
+
+def archive_name(u):
+    """File name of an agency zip file url."""
+    return u.rstrip("/").split("/")[-1]
+
+
+def remote_listing(year, base_url=None, engine=None):
+    """Parses a year's directory listing from FPDS and gets each zip file's size and date modified.
+
+    Arg:
+            year: Fiscal Year.
+            base_url: Root of the FPDS data downloads; fpds_common.FPDS_URL if None.
+            engine: Transport used for the HEAD requests; async if aiohttp is installed.
+    Returns:
+            A tuple of the listing's html and a dict of zip file name to a dict of 'url',
+            'status', 'size' and 'last_modified'.
+    """
+    directory_url, pref = find_directory(year, base_url)
+    html = requests.get(directory_url).text
+    #find_id prints a warning if the listing looks incomplete; the log is not needed here
+    zip_urls = archive_urls(find_id(html, io.StringIO()), pref, archive_suffix(year))
+    heads = make_transport(engine or ("async" if aiohttp else "threads")).head(zip_urls)
+    listing = {}
+    for u in zip_urls:
+        meta = heads[u] or {'status': None, 'size': None, 'last_modified': None}
+        listing[archive_name(u)] = dict(meta, url=u)
+    return html, listing
+
+
+def stored_listing(PATH, year):
+    """What was downloaded for a year, from its manifest or else its saved directory listing.
+
+    Returns:
+            A tuple of the source ('manifest', 'listing' or None if neither exists) and a dict of
+            zip file name to a dict of 'url', 'size' and 'mtime' (size and mtime are None when
+            read from a listing).
+    """
+    if os.path.isfile(manifest_path(PATH, year)):
+        manifest = load_manifest(PATH, year)
+        return 'manifest', {name: {'url': record['url'], 'size': record['size'], 'mtime': record['mtime']}
+            for name, record in manifest['archives'].items() if not record.get('withdrawn')}
+    directory = os.path.join(PATH, DIRECTORY_NAME % year)
+    if os.path.isfile(directory):
+        with open(directory) as f:
+            zip_urls = archive_urls(find_id(f.read(), io.StringIO()), "", archive_suffix(year))
+        return 'listing', {archive_name(u): {'url': None, 'size': None, 'mtime': None} for u in zip_urls}
+    return None, {}
+
+
+def diff(year, source, stored, remote):
+    """Compares what was downloaded for a year with what FPDS has now.
+
+    A zip file has changed if its size differs or FPDS dated it after it was downloaded.
+    Without a manifest only added and removed zip files can be found.
+
+    Arg:
+            year: Fiscal Year.
+            source: Where stored came from, from stored_listing.
+            stored: Dict from stored_listing.
+            remote: Dict from remote_listing.
+    Returns:
+            A change set dict with the year, the source, lists of 'added', 'removed' and 'changed'
+            zip files, 'unreachable' zip files the server would not describe, and a count of
+            'unchanged' ones.
+    """
+    changes = {'year': year, 'source': source, 'checked': datetime.now().isoformat(timespec='seconds'),
+        'added': [], 'removed': [], 'changed': [], 'unreachable': [], 'unchanged': 0}
+    for name in sorted(set(stored) | set(remote)):
+        old, new = stored.get(name), remote.get(name)
+        if new is None:
+            changes['removed'].append({'name': name, 'url': old['url'], 'old_size': old['size']})
+            continue
+        if new['status'] != 200:
+            changes['unreachable'].append({'name': name, 'url': new['url'], 'status': new['status']})
+            continue
+        entry = {'name': name, 'url': new['url'], 'new_size': new['size'], 'last_modified': new['last_modified']}
+        if old is None:
+            changes['added'].append(entry)
+            continue
+        reasons = []
+        if old['size'] is not None and new['size'] is not None and old['size'] != new['size']:
+            reasons.append("size %s -> %s" % (old['size'], new['size']))
+        if old['mtime'] is not None and new['last_modified'] is not None and new['last_modified'] > old['mtime'] + MTIME_TOLERANCE:
+            reasons.append("modified %s" % datetime.fromtimestamp(new['last_modified']).isoformat(timespec='seconds'))
+        if reasons:
+            changes['changed'].append(dict(entry, old_size=old['size'], reason=", ".join(reasons)))
+        else:
+            changes['unchanged'] += 1
+    return changes
+
+
+def check(root, year, base_url=None, engine=None):
+    """Diffs one year folder against FPDS.
+
+    Returns:
+            A tuple of the change set from diff and the fresh listing's html.
+    """
+    PATH = year_path(root, year)
+    source, stored = stored_listing(PATH, year)
+    html, remote = remote_listing(year, base_url, engine)
+    return diff(year, source, stored, remote), html
+
+
+def update(root, changes, html=None, engine="serial", concurrency=8):
+    """Downloads only the added and changed zip files of a change set.
+
+    Every zip file is downloaded into a staging folder and checked before anything else is
+    touched. Changed zip files that arrived whole then replace their old copies in the year
+    folder, the manifest, the catalog and the consolidated zip file; those that did not are
+    deleted from the staging folder and the old copies are kept. Removed zip files are kept,
+    and marked withdrawn in the manifest with the date they disappeared from FPDS.
+
+    Arg:
+            root: Folder containing the year folders.
+            changes: Change set from diff.
+            html: The fresh directory listing, saved over the old one once the year is updated.
+            engine: "serial", "threads" or "async", as in fpds_dl.py.
+            concurrency: Zip files downloaded at once by the threads and async engines.
+    Returns:
+            The number of zip files downloaded.
+    """
+    year = changes['year']
+    PATH = year_path(root, year)
+    os.makedirs(PATH, exist_ok=True)
+    zip_urls = [entry['url'] for kind in ('added', 'changed') for entry in changes[kind]]
+    logfile = open(os.path.join(PATH, "FPDS_DL_log_file.log"), 'a')
+    logfile.write("[%s] fpds_diff.py update: %s added, %s removed, %s changed\n" % (dtime(),
+        len(changes['added']), len(changes['removed']), len(changes['changed'])))
+    manifest = load_manifest(PATH, year)
+    catalog = fpds_catalog.connect(root)
+    consolidated = os.path.isfile(PATH + ".zip")
+    staging = os.path.join(PATH, STAGING_NAME)
+    os.makedirs(staging, exist_ok=True)
+    downloads = {}
+    if engine != "serial" and zip_urls:
+        downloads = make_transport(engine, concurrency).download(zip_urls, staging, logfile)
+    for u in zip_urls:
+        if u not in downloads:
+            downloads[u] = download_archive(u, staging, logfile)
+    arrived = {}
+    for u in zip_urls:
+        file_name_and_path, retrieved, hashes = downloads[u]
+        problem = None if retrieved else "not retrieved"
+        if not problem and os.path.isfile(file_name_and_path) and os.stat(file_name_and_path).st_size < fpds_common.PYTHON_UNZIP_LIMIT:
+            #larger zip files are left for PKZip, which reads some that Python's zipfile can't
+            problem = verify_archive(file_name_and_path)
+        if problem or not os.path.isfile(file_name_and_path):
+            #an error page saved under the zip file's name must not be consolidated later
+            logfile.write("%s was not updated (%s); the old copy is kept\n" % (archive_name(u), problem or "not saved"))
+            if os.path.isfile(file_name_and_path):
+                os.remove(file_name_and_path)
+            continue
+        arrived[u] = (file_name_and_path, hashes)
+    if consolidated:
+        #old copies come out only once their new copies are here; an added zip file can be there
+        #already if an earlier update stopped part way
+        remove_from_consolidated([archive_name(u) for u in arrived], PATH, logfile)
+    counter = 0
+    for u in zip_urls:
+        if u not in arrived:
+            continue
+        staged, hashes = arrived[u]
+        file_name_and_path = os.path.join(PATH, os.path.basename(staged))
+        os.replace(staged, file_name_and_path)
+        counter += 1
+        members = extract_archive(file_name_and_path, u, PATH, logfile)
+        record = add_archive(manifest, file_name_and_path, u, hashes, members, PATH)
+        save_manifest(manifest, PATH)
+        fpds_catalog.add_archive(catalog, year, os.path.basename(file_name_and_path), record)
+        if consolidated:
+            consolidate_archive(file_name_and_path, PATH, logfile)
+    for entry in changes['removed']:
+        if entry['name'] in manifest['archives']:
+            manifest['archives'][entry['name']]['withdrawn'] = changes['checked']
+            logfile.write("%s is no longer listed by FPDS; kept and marked withdrawn\n" % entry['name'])
+    save_manifest(manifest, PATH)
+    shutil.rmtree(staging, ignore_errors=True)
+    if consolidated:
+        fpds_catalog.index_consolidated(catalog, year, PATH + ".zip")
+    catalog.close()
+    if html is not None:
+        with open(os.path.join(PATH, DIRECTORY_NAME % year), "w") as directory:
+            directory.write(html)
+    logfile.write("%s changed zip files found \t%s downloaded\n" % (len(zip_urls), counter))
+    logfile.close()
+    return counter
+
+
+def describe(changes):
+    """Prints a change set."""
+    print("FY%s (compared with %s): %s added, %s removed, %s changed, %s unreachable, %s unchanged" % (changes['year'],
+        changes['source'] or "nothing downloaded", len(changes['added']), len(changes['removed']), len(changes['changed']),
+        len(changes['unreachable']), changes['unchanged']))
+    for entry in changes['added']:
+        print("  + %s\t%s bytes" % (entry['name'], entry['new_size']))
+    for entry in changes['removed']:
+        print("  - %s" % entry['name'])
+    for entry in changes['changed']:
+        print("  ~ %s\t%s" % (entry['name'], entry['reason']))
+    for entry in changes['unreachable']:
+        print("  ? %s\tstatus %s" % (entry['name'], entry['status']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find and download what changed on FPDS since a year was downloaded.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help in (("diff", "list added, removed and changed zip files"), ("update", "download only the changed zip files")):
+        command = commands.add_parser(name, help=help)
+        command.add_argument("root", help="folder containing the FPDS_FYyyyy year folders")
+        command.add_argument("years", type=year_range, nargs="?", help="Fiscal Year or Year Range, e.g. 2006-2016")
+        command.add_argument("--base-url", default=fpds_common.FPDS_URL, help="root of the FPDS data downloads")
+        if name == "diff":
+            command.add_argument("--json", help="save the change sets to this file")
+        else:
+            command.add_argument("--changes", help="change set file saved by diff --json, instead of diffing again")
+            command.add_argument("--engine", choices=("serial", "threads", "async"), default="serial")
+            command.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == "update" and args.changes:
+        with open(args.changes) as f:
+            change_sets = [(changes, None) for changes in json.load(f)]
+    elif args.years:
+        change_sets = [check(args.root, year, args.base_url) for year in args.years]
+    else:
+        parser.error("give the years to check, or --changes")
+    for changes, html in change_sets:
+        describe(changes)
+    if args.command == "diff":
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump([changes for changes, html in change_sets], f, indent=1)
+        return
+    for changes, html in change_sets:
+        print("FY%s: %s zip files downloaded" % (changes['year'], update(args.root, changes, html, args.engine, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@
 #import string and download libraries
 import zipfile, os, requests, sys, datetime, tkinter, re
 from tkinter import filedialog
+#import concurrent url checking
+from fpds_transport import make_transport, aiohttp
 #import audit trail library
 import trace
 
@@ -16,6 +18,9 @@ import trace
 system_path = os.path.dirname(os.path.abspath(sys.argv[0]))
 os.chdir(system_path)
 
+#check urls with asyncio when aiohttp is installed, otherwise with a thread pool
+ENGINE = "async" if aiohttp else "threads"
+
 # create a Trace object -- which will create a log file that counts the number of executions of each line below.
 tracer = trace.Trace(
      #the goal of this line -- which comes straight from the sample code -- is to generate trace files only for GAO-written code and not more than a dozen trace files for Python-supplied code
@@ -104,14 +109,13 @@ def fpds_dl(year, PATH):
         zip_urls.append(u)
         logfile.write(u+"\n")
     counter = 0
-    for u in zip_urls: #uses i index for zip_urls and links
-        try:
-            request = requests.get(u, stream=True)
-        except requests.exceptions.RequestException as e:
-            logfile.write("Can't retrieve %s: %s" % (u, e))
-            print("Can't retrieve %s: %s" % (u, e))
-            return
-        if "<title>Object not found!</title>" not in request.text:
+    #ask for the headers of every url at once instead of downloading each zip file in turn
+    statuses = make_transport(ENGINE).probe(zip_urls)
+    for u in zip_urls:
+        if statuses[u] is None:
+            logfile.write("Can't retrieve %s\n" % u)
+            print("Can't retrieve %s" % u)
+        elif statuses[u] == 200:
             counter+= 1
     logfile.write("Links found: %s /t Links working: %s" %(len(links), counter))
     logfile.close()
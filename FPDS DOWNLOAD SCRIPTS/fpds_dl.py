@@ -27,6 +27,30 @@ The user selects a base directory to contain FPDS downloads using a graphical di
 The program then creates annual subdirectories within this base directory.
 
 
+Run with --low-disk on a drive without room for a whole year three times over (downloaded ZIPs,
+unzipped XML and the consolidated ZIP). Each agency ZIP is then checked for space before it is
+downloaded, and moved into the consolidated ZIP as soon as it is unzipped, so peak disk use is
+the finished data plus about one archive.
+
+Run with --engine async (needs aiohttp) or --engine threads to download a year's ZIPs several at
+a time, --concurrency at once; they are then unzipped one by one as before.
+
+Progress, MB/s, retries and the time left in the year and in the whole run are written to
+FPDS_status.json next to the year folders every --status-interval seconds (follow it with
+python fpds_telemetry.py FPDS_status.json), and with --metrics-port are also served as
+Prometheus text on http://127.0.0.1:port/metrics.
+
+ZIPs are unzipped with the fastest inflater installed (see python fpds_inflate.py backends), or the
+one named with --inflate. With --zstd each consolidated year's XML is also written to
+FPDS_FYyyyy.tar.zst for archiving.
+
+Each zip file's stages (downloaded, verified, extracted and consolidated) are saved as they finish
+in FPDS_run_state.json next to the year folders. If a run stops part way (a crash, a reboot, a lost
+connection), run again with --resume, or --resume FOLDER to skip the dialog box, to carry on where
+it stopped with the same years and options: finished zip files are skipped, the directory is not
+fetched again and the log file is added to. With the serial engine a half downloaded zip file is
+continued from where it stopped; --engine threads and async download it again from the start.
+
 The user specifies the year(s) requested and an execution delay in the console.  
 The execution delay allows the user to launch a job at any time that will run overnight, 
 when it will not be competing with as many other GAO or FDPS users
@@ -38,22 +62,58 @@ because the FPDS server is throttling its bandwidth
 """
 
 #import string and download libraries
-import zipfile, shutil, errno, hashlib, subprocess, os, requests, sys, tkinter, re, time
+import os, requests, sys, tkinter, time, zipfile, argparse
 from tkinter import filedialog
 from datetime import datetime
+#import helpers shared with the other FPDS scripts
+from fpds_common import PKZIP, FPDS_URL, dtime, find_id, find_directory, archive_suffix, archive_urls, download_archive, extract_archive, consolidate, consolidate_archive, \
+    consolidated_names, recover_consolidated
+from fpds_manifest import load_manifest, save_manifest, add_archive
+from fpds_space import Reservation
+import fpds_catalog
+from fpds_transport import make_transport
+from fpds_telemetry import Telemetry, STATUS_NAME
+from fpds_inflate import BACKENDS, recompress, ZSTD_LEVEL, ZSTD_AVAILABLE, available_backends
+from fpds_checkpoint import Checkpoint, verify_archive
 #import audit trail library
 import trace
 
 
+#read options before the directory dialog box so that --help works without it
+parser = argparse.ArgumentParser(description="Download FPDS zip files for a fiscal year or year range.")
+parser.add_argument("--low-disk", action="store_true",
+    help="check and reserve space before each download and consolidate each archive as soon as it is unzipped")
+parser.add_argument("--engine", choices=("serial", "threads", "async"), default="serial",
+    help="download one zip file at a time (serial), or several at once with threads or asyncio")
+parser.add_argument("--concurrency", type=int, default=8, help="zip files downloaded at once by threads or async")
+parser.add_argument("--status-interval", type=float, default=5, help="seconds between updates of the status file")
+parser.add_argument("--metrics-port", type=int, help="serve progress as Prometheus text on this port on localhost")
+parser.add_argument("--inflate", choices=list(BACKENDS), help="inflate backend used to unzip (default: fastest installed)")
+parser.add_argument("--zstd", type=int, nargs="?", const=ZSTD_LEVEL, metavar="LEVEL",
+    help="also write each year's XML to FPDS_FYyyyy.tar.zst, at this zstd level (default %s)" % ZSTD_LEVEL)
+parser.add_argument("--resume", nargs="?", const="", metavar="FOLDER",
+    help="carry on the unfinished run saved in FOLDER (or the folder picked in the dialog box), with its years and options")
+parser.add_argument("--base-url", help="root of the FPDS data downloads, such as a fpds_mock_server.py url (default %s)" % FPDS_URL)
+args = parser.parse_args()
+if args.low_disk and args.engine != "serial":
+    parser.error("--low-disk downloads one zip file at a time; it cannot be used with --engine %s" % args.engine)
+if args.inflate and args.inflate not in available_backends():
+    parser.error("--inflate %s is not installed: pip install %s" % (args.inflate, args.inflate))
+if args.zstd is not None and not ZSTD_AVAILABLE:
+    parser.error("--zstd needs zstandard: pip install zstandard")
+
 #this assertion suffices to prevent execution on VDI
-assert os.path.isfile(r"C:\progra~1\PKWARE\PKZIPC\pkzipc.exe"), "The required PK ZIP program, PKZipC.exe, was not found in C:\\progra~1\\PKWARE\\PKZIPC\\!  This program requires that executable; and must be run on a computer with it -- such as a GAO windows 7 tower."
+assert os.path.isfile(PKZIP), "The required PK ZIP program, PKZipC.exe, was not found in C:\\progra~1\\PKWARE\\PKZIPC\\!  This program requires that executable; and must be run on a computer with it -- such as a GAO windows 7 tower."
 
 #set the directory to the path containing this script; doing so allows the tracing to work.
 #otherwise you get errno 2; see: http://stackoverflow.com/questions/15725273/python-oserror-errno-2-no-such-file-or-directory
 #Setup tkinter to create filedirectory box
-root = tkinter.Tk()
-root.withdraw()
-user_path = filedialog.askdirectory()
+if args.resume:
+    user_path = args.resume
+else:
+    root = tkinter.Tk()
+    root.withdraw()
+    user_path = filedialog.askdirectory()
 os.chdir(user_path)
 
 # create a Trace object -- which will create a log file that counts the number of executions of each line below.
@@ -64,218 +124,173 @@ tracer = trace.Trace(
      trace=0,
      count=1)
 
-def dtime(path=""):
-    """Gets current time or date modified time.
-    
-    If no path is provided, returns current time. If path is provided, returns time the file was modified.
-    
-    Arg:
-            path: The path of the file you want to get the date modified.
-    Returns:
-            Current time or date modified time in the format 'mm/dd/yyyy H:M:S AM/PM'.
-    """
-    if path=="":
-        return (datetime.now().strftime('%m/%d/%Y %I:%M:%S %p'))
-    else:
-        return (datetime.fromtimestamp(int(os.stat(path).st_mtime)).strftime('%m/%d/%Y %I:%M:%S %p'))
-
-def find_id(html_string, logfile):
-    """Obtains agency IDs to be used for scraping FPDS zip files.
-
-    This pulls out all elements called "id" and writes them to an array
-    by using regular expresions (it takes everything between 'id="4' and '">').
-
-    Arg:
-            html_string: A string of html from the FPDS direcotry for a particular Fiscal Year.
-    Returns:
-            A list of agency IDs to be used in creating zipfile urls.
-    """
-
-    IDs = re.findall("id=\"4(.*?)\">",html_string)
-    foldergifs = re.findall("images/folder.gif",html_string)
-    #check to see if the regular expression captured all of the IDs
-    if len(IDs) != len(foldergifs): #if the # of IDs found does not match the number of folder.gif pictures
-         logfile.write('All IDs not found. Check html directory. Found %s IDs and %s foldergifs' % (len(IDs), len(foldergifs)))
-         print('All IDs not found. Check html directory. Found %s IDs and %s foldergifs' % (len(IDs), len(foldergifs)))
-    return IDs
-
-
-def fpds_dl(year, PATH):
+def fpds_dl(year, PATH, low_disk=False, engine="serial", concurrency=8, telemetry=None, backend=None, zstd_level=None, checkpoint=None,
+        base_url=None):
     """Downloads all FPDS data for a particular Fiscal Year.
 
     This builds URLs for each agency's zip file, then downloads and unzips the files under 50mb.
-    Files greater than 50mb must be unzipped with PKZip by running the batch file in VDI.
+    Files greater than 50mb are unzipped with PKZip.
     An html of the directory is downloaded. A log file is created containing: 
     Time script ran, a check that the zip files contain an IDV and AWARD file, file sizes, file date times, 
-    and an md5 hash of the zip content.
+    and an md5 hash of the zip content. A manifest of every zip file and unzipped file, with sizes,
+    date modified times, md5 and sha256 hashes and urls, is saved in the year folder.
 
     Arg:
             year: The Fiscal Year you want to download.
+            PATH: Year folder to save files in.
+            low_disk: Reserve space for each archive before downloading it, and move it into the
+                      consolidated zip file as soon as it is unzipped instead of at the end.
+            engine: "serial" to download each zip file just before unzipping it, or "threads" or
+                    "async" to download them all first, concurrency at a time.
+            concurrency: Zip files downloaded at once by the threads and async engines.
+            telemetry: fpds_telemetry.Telemetry to report progress to, or None.
+            backend: Inflate backend from fpds_inflate.BACKENDS, or None for the fastest installed.
+            zstd_level: Write the year's XML to FPDS_FYyyyy.tar.zst at this level, or None not to.
+            checkpoint: fpds_checkpoint.Checkpoint to save each zip file's stages in, and to skip
+                        the stages an earlier run finished, or None.
+            base_url: Root of the FPDS data downloads; fpds_common.FPDS_URL if None.
     Returns:
             Nothing. Saves files.
     """
-    #setup logfile
+    #setup logfile; a resumed year adds to the log of the run that stopped
     print (PATH)
-    logfile = open(os.path.join(PATH, "FPDS_DL_log_file.log"),'w')
-    logfile.write("[%s] fpds_dl.py began run\n" % dtime())
-
-    yy = str(year)[-2:]
-    #get url from main directory to use to pull the agency IDs
-    #FY16 directory is formatted different from other years it seprates with a _ instead of a -
-    #This pulls the folder name directly from the home directory with all years using regex
-    directory_all = requests.get("https://www.fpds.gov/ddps/directory_browser/index.php?somepath=")
-    directory_year = re.findall("a href=\"(.*?)\">",directory_all.text)
-    #From the list of directory links, find the directory for the input year
-    regex = re.compile(".*(%s).*" % yy)
-    directory_end = [m.group(0) for l in directory_year for m in [regex.search(l)] if m][0]
-    #example: https://www.fpds.gov/ddps/directory_browser/index.php?somepath=..%2FFY13-V1.4&n=2
-    directory_url = "https://www.fpds.gov/ddps/directory_browser/index.php%s" % directory_end
-    #prefix and suffix we use to build the urls for the zip files
-    prefend = re.findall("%2(.*?)&n=2",directory_end)[0][1:]
-    pref = "https://www.fpds.gov/ddps/%s/" % prefend
-    if 2003 < year < 2015:
-        suf = "-DEPTOctober" + str(year-1) + "-Archive.zip"
-        #after 2015, the suffix is different
-    elif 2015<= year <= datetime.now().year:
-        suf = "-DEPT-1001" + str(year-1) + "TO0930" + str(year) + "-Archive.zip"
-    else:
+    resumed = checkpoint is not None and checkpoint.started(year)
+    logfile = open(os.path.join(PATH, "FPDS_DL_log_file.log"),'a' if resumed else 'w')
+    logfile.write("[%s] fpds_dl.py %s run\n" % (dtime(), "resumed" if resumed else "began"))
+    if checkpoint:
+        checkpoint.logfile = logfile
+
+    #suffix we use to build the urls for the zip files
+    try:
+        suf = archive_suffix(year)
+    except ValueError:
         logfile.write('%s Year out of bounds\n' % year)
-        raise ValueError('%s Year out of bounds' % year)
-
-    # Download directory_url
-    f = requests.get(directory_url, stream = True)
-    # Save directory
-    path_directory = os.path.join(PATH, "FPDS_directory_FY%s.html" % year)
-    with open(path_directory, "w") as directory:
-        directory.write(f.text)
-        logfile.write("[%s] Saved directory of FPDS for FY %s\n" %(dtime(), year))
-        logfile.write("Filename: %s %s bytes.\n" % (path_directory, os.stat(path_directory)))
-    #Get zipfile links of agency IDs
-    links = find_id(f.text, logfile)
-    logfile.write("Agency IDs obtained: %r\n" % links)
-    logfile.write("Zip urls attempted to downloaded:\n")
-    # Download files and unzip
-    #links2 = links[0:3] #Tests subset of file
-    # create urls
-    zip_urls=[]
-    for l in links: #Change to links to dl all
-        if l == 'OTHER_DOD_AGENCIES': #special case for OTHER DOD. Second ID is DOD-OTHER_DOD
-            u = pref + l + "/DOD-OTHER_DOD" + suf
-        else:
-            u = pref + l + "/" + l + suf #url contains the agency ID twice
-        zip_urls.append(u)
-        logfile.write(u+"\n")
+        raise
+
+    if resumed and checkpoint.year(year)['zip_urls'] is not None:
+        #the directory was saved and parsed by the earlier run
+        links, zip_urls = checkpoint.year(year)['links'], checkpoint.year(year)['zip_urls']
+        logfile.write("[%s] Using the %s zip urls found by the earlier run\n" % (dtime(), len(zip_urls)))
+    else:
+        #get url from main directory to use to pull the agency IDs
+        directory_url, pref = find_directory(year, base_url)
+        # Download directory_url
+        f = requests.get(directory_url, stream = True)
+        # Save directory
+        path_directory = os.path.join(PATH, "FPDS_directory_FY%s.html" % year)
+        with open(path_directory, "w") as directory:
+            directory.write(f.text)
+            logfile.write("[%s] Saved directory of FPDS for FY %s\n" %(dtime(), year))
+            logfile.write("Filename: %s %s bytes.\n" % (path_directory, os.stat(path_directory)))
+        #Get zipfile links of agency IDs
+        links = find_id(f.text, logfile)
+        logfile.write("Agency IDs obtained: %r\n" % links)
+        logfile.write("Zip urls attempted to downloaded:\n")
+        # create urls
+        zip_urls = archive_urls(links, pref, suf)
+        for u in zip_urls:
+            logfile.write(u+"\n")
+        if checkpoint:
+            checkpoint.record_listing(year, links, zip_urls)
     counter = 0 #initialize counter that checks if all identified files were downloaded
     if len(zip_urls) != len(links):
         logfile.write("ERROR: Missing some zip urls\n")
-    for u in zip_urls:
-        try:
-            request = requests.get(u, stream=True)
-        except requests.exceptions.RequestException as e:
-            logfile.write("Can't retrieve %s: %s\n" % (u, e))
-            print("Can't retrieve %s: %s" % (u, e))
-        try:
-            request = requests.get(u, stream=True)
-        except requests.exceptions.RequestException as e:
-            logfile.write("Can't retrieve %s: %s\n" % (u, e))
-            print("Can't retrieve %s: %s" % (u, e))
-        if request.status_code == 200:
+    manifest = load_manifest(PATH, year)
+    #the catalog of every year lives next to the year folders
+    catalog = fpds_catalog.connect(os.path.dirname(PATH))
+    reservation = Reservation(PATH)
+    if low_disk and recover_consolidated(PATH, logfile):
+        print("Restored %s.zip, which the earlier run left half written" % PATH)
+    #the last stage of each zip file; without --low-disk they are consolidated together at the end
+    last = 'consolidated' if low_disk else 'extracted'
+    name = lambda u: u.rstrip("/").split("/")[-1]
+    done = lambda u, stage: checkpoint is not None and checkpoint.has(year, name(u), stage)
+    if resumed:
+        finished = sum(done(u, last) for u in zip_urls)
+        counter += finished
+        logfile.write("[%s] %s of %s zip files were finished by the earlier run\n" % (dtime(), finished, len(zip_urls)))
+    pending = [u for u in zip_urls if not done(u, last)]
+    if telemetry:
+        telemetry.plan(year, [u for u in pending if not done(u, 'downloaded')])
+        telemetry.stage = "download"
+    downloads = {}
+    if engine != "serial":
+        downloads = make_transport(engine, concurrency).download([u for u in pending if not done(u, 'downloaded')], PATH, logfile, telemetry)
+    # Download files and unzip
+    for u in pending:
+        file_name_and_path = os.path.join(PATH, name(u))
+        if low_disk and done(u, 'extracted') and name(u) in consolidated_names(PATH):
+            #the earlier run stopped after copying the zip file into the consolidated zip file but before deleting it
+            if os.path.isfile(file_name_and_path):
+                os.remove(file_name_and_path)
+            checkpoint.mark(year, name(u), 'consolidated')
             counter+= 1
+            continue
+        if low_disk and done(u, 'extracted') and os.path.isfile(file_name_and_path) and name(u) in manifest['archives']:
+            #the earlier run unzipped it and recorded it in the manifest, then stopped before consolidating it
+            logfile.write("[%s] %s was unzipped by the earlier run\n" % (dtime(), name(u)))
+            counter+= 1
+            consolidate_archive(file_name_and_path, PATH, logfile)
+            manifest['consolidated'] = os.path.basename(PATH) + ".zip"
+            save_manifest(manifest, PATH)
+            checkpoint.mark(year, name(u), 'consolidated')
+            continue
+        if low_disk:
+            #stops the run here, before anything is written, if the drive is too full for this archive
+            reservation.plan(u, logfile)
+            reservation.release('download')
+        #left part downloaded by the earlier run
+        partial = resumed and u not in downloads and not done(u, 'downloaded') and os.path.isfile(file_name_and_path)
+        if done(u, 'downloaded') and os.path.isfile(file_name_and_path):
+            retrieved, hashes = True, checkpoint.archive(year, name(u)).get('hashes')
+        elif u in downloads:
+            file_name_and_path, retrieved, hashes = downloads[u]
         else:
-            logfile.write("%s Can't retrieve %s\n" % (request.status_code, u))
-            print("%s Can't retrieve %s" % (request.status_code, u))
-        fname = re.search("([^/]+$)",u).group(0)
-        file_name_and_path = os.path.join(PATH, fname)
-        try:
-            # Initilize md5 hash key
-            hash_md5 = hashlib.md5()
-            hash_all_updated = True
-            with open(file_name_and_path, "wb+") as zip_file:
-                # Write the contents of the downloaded file chunk by chunk into the new file
-                for chunk in request.iter_content(chunk_size=1024):
-                    if chunk: # filter out keep-alive new chunks
-                        zip_file.write(chunk)
-                        #add data to hash key
-                        try:
-                            hash_md5.update(chunk)
-                        except:
-                            hash_all_updated = False
-            #if every chunk was captured in the hash output the hash key
-            if hash_all_updated:
-                hash_text = " md5: %s" % hash_md5.hexdigest()
-            else: hash_text = "hash not updated succesfully"
-            #record information about the file we are currently reading
-            logfile.write("[%s] Saved %s\t%s bytes. %s\n" % (dtime(file_name_and_path), fname, os.stat(file_name_and_path).st_size, hash_text))
-        except:
-            logfile.write("File %s not saved\n" % u)
-        
-        #open recently downloaded zip file
-        with open(file_name_and_path, 'rb') as fileobj:
-            try:
-                filezip = zipfile.ZipFile(fileobj, allowZip64=True)
-                idv = False
-                award = False
-                for member in filezip.infolist():
-                    #check IDV files and AWARD files exist in the zip file
-                    if re.search("-[^-]*.xml$",member.filename).group(0) == "-IDV.xml": idv=True
-                    if re.search("-[^-]*.xml$",member.filename).group(0) == "-AWARD.xml": award=True
-                                        #Log missing file (IDV or AWARD)
-                    if not (idv and award):
-                        logfile.write("Missing %s %s for %s\n" % ("IDV.xml"*idv, "AWARD.xml"*award, fname))
-
-                    #only unzip the current member with Python if the ZIP file is small enough that Python should work
-                    if os.stat(file_name_and_path).st_size < 50000000:  #if zip file size less than 50mb, handle in python
-                        try:
-                            target_path = os.path.join(PATH, member.filename)
-                            if target_path.endswith('/'):  # folder entry, create
-                                try:
-                                    os.makedirs(target_path)
-                                except (OSError, IOError) as err:
-                                    # Ignore Windows error if the folders already exist
-                                    if err.errno != errno.EEXIST:
-                                        raise
-                                continue
-                            with open(target_path, 'wb') as outfile, filezip.open(member) as infile:
-                                shutil.copyfileobj(infile, outfile)
-                            #Preserve file modified time by manually changing it
-                            date_time = time.mktime(member.date_time + (0, 0, -1))
-                            os.utime(target_path, (date_time, date_time))
-                            file_time = datetime(*member.date_time).strftime('%Y-%m-%d %H:%M:%S')
-                            #Log file name, file size, and file modified time, for files unzipped
-                            logfile.write("%s %s bytes.\tDate modified: %s\n" % (member.filename, member.file_size, file_time))
-                        except zipfile.error as e:
-                            logfile.write('%s did not unzip correctly.: %s\n' % (member, e))
-                #if zip file size greater than or equal to 50mb, shell out to PKZIP to extract everything in one operation
-                #we do so outside the loop.
-                if os.stat(file_name_and_path).st_size >= 50000000:  
-                #logfile.write("File %s too large. Run Batch file to unzip with PKZip.\n" % file_name_and_path)
-                #extract_batch_file.write("C:\\progra~1\\PKWARE\\PKZIPC\\pkzipc.exe -extract %s\n" % file_name_and_path)
-                #contains_batch = True
-                #THIS CODE BLOCK DOES NOT WORK ON VDI BECAUSE OUR PKZIP LICENSE DOES NOT
-                #ALLOW "SERVER" INSTALLATIONS, AND APPARENTLY CALLING IT FROM CITRIX LOOKS LIKE A SERVER INSTALLATION TO IT
-                #on VDI, it throws the following exception:
-                # 253
-                #['pkzipc.exe', '-extract', '4100-MERITSYSTEMSPROTECTIONBOARD.zip']
-                #b'PKZIP(R)  Version 14 ZIP Compression Utility for Windows Evaluation Version \r\nPortions copyright (C) 1989-2014 PKWARE, Inc.  All Rights Reserved. \r\nReg. U.S. Pat. and Tm. Off.  Patent No.
-                # 5,051,745  7,793,099  7,844,579  \r\n7,890,465  7,895,434;  Other patents pending\r\n\r\n\r\n\r\nPKZIP: (E253) This program is not licensed for use on Windows Server platforms.\r\nPlease contact
-                #PKWARE to obtain an appropriate server product for this machine.\r\n'
-                    subprocess_results= ""
-                    try:
-                        #change directory so that the unzipped files land in the right place
-                        os.chdir(PATH)                        
-                        subprocess_results = subprocess.check_output([r"C:\progra~1\PKWARE\PKZIPC\pkzipc.exe","-extract", file_name_and_path],  stderr=subprocess.STDOUT)
-                        logfile.write(repr(subprocess_results)+"\n")
-                        #out of an abundance of caution, reset the working directory to what it has traditionally been for
-                        #all the program execution
-                        os.chdir(user_path)
-                    except CalledProcessError as e:
-                        print(repr(e.returncode))
-                        print(repr(e.cmd))
-                        print(repr(e.output))
-                    except Exception as e:
-                        print(repr(e))
-            except zipfile.error as e:
-                logfile.write('%s is not a zip file. (url=%s): %s\n' % (fileobj, u, e))
+            #a zip file the earlier run was part way through is continued from where it stopped
+            file_name_and_path, retrieved, hashes = download_archive(u, PATH, logfile, telemetry=telemetry, resume=partial)
+        if retrieved:
+            counter+= 1
+            if checkpoint and not done(u, 'downloaded'):
+                checkpoint.mark(year, name(u), 'downloaded', hashes=hashes)
+        elif checkpoint:
+            #whatever was saved is kept for --resume to continue, rather than unzipped and marked done
+            continue
+        if os.path.isfile(file_name_and_path):
+            if checkpoint and not done(u, 'verified'):
+                problem = verify_archive(file_name_and_path, full=partial)
+                if problem and partial:
+                    #the two halves do not make one zip file; get the whole of it again
+                    logfile.write("%s does not unzip after resuming (%s); downloading it again\n" % (name(u), problem))
+                    file_name_and_path, retrieved, hashes = download_archive(u, PATH, logfile)
+                    if not retrieved:
+                        #the joined file was marked downloaded; forget that so --resume gets it again
+                        checkpoint.clear(year, name(u), 'downloaded')
+                        counter-= 1
+                        continue
+                    checkpoint.mark(year, name(u), 'downloaded', hashes=hashes)
+                    problem = verify_archive(file_name_and_path)
+                if problem:
+                    #very large zip files can be too much for Python's zipfile but not for PKZip
+                    logfile.write("Python's zipfile can't open %s: %s\n" % (name(u), problem))
+                checkpoint.mark(year, name(u), 'verified', problem=problem)
+            if telemetry:
+                telemetry.stage = "unzip %s" % os.path.basename(file_name_and_path)
+            reservation.release('extract')
+            members = extract_archive(file_name_and_path, u, PATH, logfile, backend=backend)
+            #record the zip file and its members in the manifest as soon as they are on disk
+            record = add_archive(manifest, file_name_and_path, u, hashes, members, PATH)
+            save_manifest(manifest, PATH)
+            fpds_catalog.add_archive(catalog, year, os.path.basename(file_name_and_path), record)
+            if checkpoint:
+                checkpoint.mark(year, name(u), 'extracted')
+            if low_disk:
+                reservation.release('consolidate')
+                consolidate_archive(file_name_and_path, PATH, logfile)
+                manifest['consolidated'] = os.path.basename(PATH) + ".zip"
+                save_manifest(manifest, PATH)
+                if checkpoint:
+                    checkpoint.mark(year, name(u), 'consolidated')
+    reservation.close()
 
     #Log error message if number of files downloaded does not match the number of links found
     if len(links)!=counter:
@@ -284,23 +299,80 @@ def fpds_dl(year, PATH):
     print("%s links found \t%s links downloaded" %(len(links), counter))
     logfile.write("%s links found \t%s links downloaded\n" %(len(links), counter))
 
-
-    subprocess_results= ""
-    try:
-        subprocess_results = subprocess.check_output([r"C:\progra~1\PKWARE\PKZIPC\pkzipc.exe","-add", "-store", "-move", PATH +".zip", os.path.join(PATH, "*.zip")],  stderr=subprocess.STDOUT)
-        logfile.write(repr(subprocess_results)+"\n")
-    except CalledProcessError as e:
-        print(repr(e.returncode))
-        print(repr(e.cmd))
-        print(repr(e.output))
-    except Exception as e:
-        print(repr(e))
+    if telemetry:
+        telemetry.stage = "consolidate"
+    if not low_disk:
+        held_back = []
+        if checkpoint:
+            #PKZip moves every zip file in the folder; a download that failed part way must not go in
+            for u in zip_urls:
+                file_name_and_path = os.path.join(PATH, name(u))
+                if not done(u, 'downloaded') and os.path.isfile(file_name_and_path):
+                    with open(file_name_and_path, 'rb') as f:
+                        is_zip = f.read(4) == b"PK\x03\x04"
+                    if is_zip:
+                        #kept aside for --resume to continue from where it stopped
+                        os.replace(file_name_and_path, file_name_and_path + ".part")
+                        held_back.append(file_name_and_path)
+                    else:
+                        #an error page from the server; nothing worth continuing
+                        os.remove(file_name_and_path)
+                        logfile.write("Deleted %s, which is not a zip file\n" % name(u))
+        consolidate(PATH, logfile)
+        for file_name_and_path in held_back:
+            os.replace(file_name_and_path + ".part", file_name_and_path)
+        if checkpoint:
+            #PKZip's errors are only printed, so check what actually went into the consolidated zip file
+            try:
+                in_zip = consolidated_names(PATH)
+            except (OSError, zipfile.error) as e:
+                logfile.write("ERROR: Can't read %s: %s\n" % (os.path.basename(PATH) + ".zip", e))
+                in_zip = set()
+            extracted = [name(u) for u in zip_urls if done(u, 'extracted')]
+            checkpoint.mark_all(year, [n for n in extracted if n in in_zip], 'consolidated')
+            for n in extracted:
+                if n not in in_zip:
+                    logfile.write("ERROR: %s was not moved into %s\n" % (n, os.path.basename(PATH) + ".zip"))
+    manifest['consolidated'] = os.path.basename(PATH) + ".zip"
+    save_manifest(manifest, PATH)
+    if os.path.isfile(PATH + ".zip"):
+        fpds_catalog.index_consolidated(catalog, year, PATH + ".zip")
+        if zstd_level is not None:
+            if telemetry:
+                telemetry.stage = "zstd"
+            try:
+                target, written, skipped = recompress(PATH + ".zip", level=zstd_level, backend=backend)
+            except (OSError, zipfile.error) as e:
+                #the year is downloaded and consolidated; only the zstd copy is missing
+                logfile.write("[%s] Could not write the zstd archive of %s: %s\n" % (dtime(), os.path.basename(PATH) + ".zip", e))
+                print("Could not write the zstd archive of %s: %s" % (os.path.basename(PATH) + ".zip", e))
+            else:
+                for agency, error in skipped:
+                    logfile.write("%s left out of the zstd archive: %s\n" % (agency, error))
+                logfile.write("[%s] Wrote %s bytes of XML into %s\t%s bytes\n" % (dtime(), written, target, os.stat(target).st_size))
+    catalog.close()
+    if checkpoint:
+        outstanding = [name(u) for u in zip_urls if not done(u, 'consolidated')]
+        if outstanding:
+            #left open, so that --resume comes back for them
+            logfile.write("[%s] FY%s is not finished. Left for --resume: %s\n" % (dtime(), year, ", ".join(outstanding)))
+            print("FY%s is not finished: %s zip file(s) left for --resume" % (year, len(outstanding)))
+        else:
+            checkpoint.finish_year(year)
+        checkpoint.logfile = None
     logfile.close()
 
 
 
     #run program above asking for inputs for fiscal year(s) and save directory
 def main(user_path):
+    checkpoint = Checkpoint(user_path)
+    if args.resume is not None:
+        if not checkpoint.resumable():
+            sys.exit("There is no unfinished run to resume in %s" % user_path)
+        #carry on with the years and options the run was started with
+        run(user_path, checkpoint, checkpoint.state['years'], checkpoint.state['options'])
+        return
     #check input for alphanumeric year from 2003 to current year
     while True:
         y = input("Enter Fiscal Year or Year Range: ")
@@ -337,11 +409,33 @@ def main(user_path):
         ylist = list(range(ylist[0],ylist[1]+1))
     t = input("Enter Download Delay (in hours): ")
     time.sleep(int(t)*3600) #time.sleep uses seconds
-    for YEAR in ylist:
-        #Create folder(s) in path named FPDS_FY + 'user year'
-        os.makedirs(os.path.normpath(os.path.join(user_path, "FPDS_FY"+str(YEAR))),exist_ok=True)
-        PATH = os.path.normpath(os.path.join(user_path, "FPDS_FY"+str(YEAR)))
-        fpds_dl(YEAR, PATH)
+    checkpoint.start(ylist, {'low_disk': args.low_disk, 'engine': args.engine, 'concurrency': args.concurrency,
+        'inflate': args.inflate, 'zstd': args.zstd, 'base_url': args.base_url})
+    run(user_path, checkpoint, ylist, checkpoint.state['options'])
+
+
+def run(user_path, checkpoint, ylist, options):
+    """Downloads each year not already finished, saving progress in checkpoint."""
+    telemetry = Telemetry(os.path.join(user_path, STATUS_NAME), args.status_interval, args.metrics_port)
+    telemetry.plan_run([YEAR for YEAR in ylist if not checkpoint.done(YEAR)])
+    try:
+        for YEAR in ylist:
+            if checkpoint.done(YEAR):
+                print("FY%s was finished by the earlier run" % YEAR)
+                continue
+            #Create folder(s) in path named FPDS_FY + 'user year'
+            os.makedirs(os.path.normpath(os.path.join(user_path, "FPDS_FY"+str(YEAR))),exist_ok=True)
+            PATH = os.path.normpath(os.path.join(user_path, "FPDS_FY"+str(YEAR)))
+            fpds_dl(YEAR, PATH, options['low_disk'], options['engine'], options['concurrency'], telemetry, options['inflate'],
+                options['zstd'], checkpoint, options.get('base_url'))
+            telemetry.finish_year()
+        unfinished = [YEAR for YEAR in ylist if not checkpoint.done(YEAR)]
+        if unfinished:
+            print("FY%s not finished; run again with --resume %s" % (", FY".join(str(YEAR) for YEAR in unfinished), user_path))
+        else:
+            checkpoint.finish()
+    finally:
+        telemetry.close()
 
 
 # run the whole above program while using the tracer object to log which lines got executed.  This is separate from "logging," the file I/O log above
@@ -0,0 +1,258 @@
+# fpds_inflate
+###############################
+# Purpose: Faster unzipping of agency zip files, and zstd archives of a year.
+#          member_chunks reads a member's compressed bytes straight from the zip
+#          file and inflates them with a choice of backend: the standard zlib,
+#          or zlib-ng (pip install zlib-ng) or ISA-L (pip install isal), which
+#          inflate several times faster. Stored members are copied without
+#          going through an inflater at all. Every member's CRC-32 and size are
+#          checked like zipfile checks them. "zipfile" uses zipfile's own
+#          member reader, as fpds_dl.py always did.
+#          recompress writes a year's XML, read out of the consolidated zip
+#          file, into FPDS_FYyyyy.tar.zst (pip install zstandard), which is much
+#          smaller for archiving than the zip files' deflate.
+#
+# Usage:   python fpds_inflate.py backends
+#          python fpds_inflate.py recompress D:\data\fpds\downloaded\FPDS_FY2016.zip --level 19
+
+import os, sys, time, zlib, struct, tarfile, zipfile, argparse, tempfile
+
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_AVAILABLE = zstd is not None or zstandard is not None
+#inflater modules by name; None means the module is not installed
+BACKENDS = {'zipfile': zlib, 'zlib': zlib, 'zlib-ng': zlib_ng, 'isal': isal_zlib}
+#fastest backend installed
+DEFAULT_BACKEND = next(name for name in ('isal', 'zlib-ng', 'zlib') if BACKENDS[name])
+#compressed bytes read at a time
+CHUNK_SIZE = 262144
+#zstd level used by recompress; 19 is much smaller but runs at under 1 MB/s, hours for a whole year
+ZSTD_LEVEL = 3
+#unzipped bytes of a member held in memory by recompress before it spills to a temporary file
+SPOOL_SIZE = 67108864
+#length of a zip local file header before its file name and extra field
+LOCAL_HEADER_SIZE = 30
+LOCAL_HEADER = b"PK\x03\x04"
+
+
+def available_backends():
+    """Names of the backends that are installed."""
+    return [name for name, module in BACKENDS.items() if module]
+
+
+def member_chunks(filezip, fileobj, member, backend=None, chunk_size=CHUNK_SIZE):
+    """Yields the unzipped bytes of one zip member, a chunk at a time.
+
+    Arg:
+            filezip: Open zipfile.ZipFile.
+            fileobj: The binary file filezip was opened on.
+            member: ZipInfo of the member.
+            backend: Name in BACKENDS; DEFAULT_BACKEND if None.
+            chunk_size: Compressed bytes read at a time.
+    Raises:
+            zipfile.BadZipFile: the member's CRC-32 or size is wrong, or its header is not found.
+            zlib.error: the compressed data is corrupt.
+            EOFError: the zip file ends before the member does.
+    """
+    backend = backend or DEFAULT_BACKEND
+    module = BACKENDS[backend]
+    if module is None:
+        raise ImportError("The %s backend is not installed: pip install %s" % (backend, backend))
+    if backend == "zipfile" or member.flag_bits & 0x1 or member.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        #encrypted, or compressed with something other than deflate
+        with filezip.open(member) as infile:
+            yield from iter(lambda: infile.read(chunk_size), b"")
+        return
+    fileobj.seek(member.header_offset)
+    header = fileobj.read(LOCAL_HEADER_SIZE)
+    if header[:4] != LOCAL_HEADER:
+        raise zipfile.BadZipFile("Bad magic number for file header of %s" % member.filename)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    fileobj.seek(member.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+    inflater = module.decompressobj(-15) if member.compress_type == zipfile.ZIP_DEFLATED else None
+    left = member.compress_size
+    crc = 0
+    size = 0
+    while left:
+        data = fileobj.read(min(chunk_size, left))
+        if not data:
+            raise EOFError("%s ends before %s does" % (filezip.filename, member.filename))
+        left -= len(data)
+        if inflater:
+            try:
+                data = inflater.decompress(data)
+            except module.error as e:
+                raise zlib.error("Error inflating %s: %s" % (member.filename, e))
+        if data:
+            crc = module.crc32(data, crc)
+            size += len(data)
+            yield data
+    if inflater:
+        data = inflater.flush()
+        if data:
+            crc = module.crc32(data, crc)
+            size += len(data)
+            yield data
+    if crc != member.CRC or size != member.file_size:
+        raise zipfile.BadZipFile("Bad CRC-32 or size for file %r" % member.filename)
+
+
+class ArchiveSlice:
+    """Read-only file over one agency zip file stored inside the consolidated zip file."""
+
+    def __init__(self, fileobj, start, length):
+        self.fileobj = fileobj
+        self.start = start
+        self.length = length
+        self.position = 0
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        self.position = max(0, [offset, self.position + offset, self.length + offset][whence])
+        return self.position
+
+    def read(self, n=-1):
+        n = self.length - self.position if n is None or n < 0 else min(n, self.length - self.position)
+        self.fileobj.seek(self.start + self.position)
+        data = self.fileobj.read(n)
+        self.position += len(data)
+        return data
+
+
+def zstd_writer(raw, level):
+    """Opens a zstd compressing stream over a binary file, with the stdlib module or zstandard."""
+    if zstd is not None:
+        return zstd.ZstdFile(raw, 'wb', level=level)
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=level, threads=-1, write_checksum=True).stream_writer(raw, closefd=False)
+    raise ImportError("zstd recompression needs zstandard: pip install zstandard")
+
+
+def recompress(consolidated, target=None, level=ZSTD_LEVEL, backend=None):
+    """Writes the XML of a consolidated year zip file into a zstd compressed tar file.
+
+    Each agency zip file's members go into the tar file under a folder named after the agency
+    zip file, keeping their date modified. Agency zip files stored without compression (as
+    consolidate and consolidate_archive store them) are read in place. Each member is inflated
+    once, into a temporary file, and only goes into the tar file once its CRC-32 checks out; a
+    member Python's zipfile can't read is left out, as is an agency zip file it can't open (a
+    broken one, or one of the very large ones left to PKZip).
+
+    Arg:
+            consolidated: Path of FPDS_FYyyyy.zip.
+            target: Path of the tar file; FPDS_FYyyyy.tar.zst next to consolidated if None.
+            level: zstd compression level.
+            backend: Inflate backend, as in member_chunks.
+    Returns:
+            A tuple of the target path, the number of XML bytes written into it, and a list of
+            (name, error) for the agency zip files and members (as agency/member) left out.
+    """
+    target = target or consolidated[:-len(".zip")] + ".tar.zst"
+    written = 0
+    skipped = []
+    try:
+        written = _recompress(consolidated, target, level, backend, skipped)
+    except BaseException:
+        if os.path.isfile(target + ".tmp"):
+            os.remove(target + ".tmp")
+        raise
+    os.replace(target + ".tmp", target)
+    return target, written, skipped
+
+
+def _recompress(consolidated, target, level, backend, skipped):
+    written = 0
+    with open(consolidated, 'rb') as outer_file, zipfile.ZipFile(outer_file, allowZip64=True) as outer, \
+            open(target + ".tmp", 'wb') as raw:
+        with zstd_writer(raw, level) as out, tarfile.open(fileobj=out, mode='w|', format=tarfile.PAX_FORMAT,
+                copybufsize=CHUNK_SIZE) as tar:
+            for agency in outer.infolist():
+                if agency.compress_type == zipfile.ZIP_STORED:
+                    outer_file.seek(agency.header_offset)
+                    name_length, extra_length = struct.unpack("<HH", outer_file.read(LOCAL_HEADER_SIZE)[26:30])
+                    inner_file = ArchiveSlice(open(consolidated, 'rb'), agency.header_offset + LOCAL_HEADER_SIZE
+                        + name_length + extra_length, agency.file_size)
+                else:
+                    inner_file = outer.open(agency)
+                stem = os.path.splitext(os.path.basename(agency.filename))[0]
+                try:
+                    with zipfile.ZipFile(inner_file, allowZip64=True) as inner:
+                        for member in inner.infolist():
+                            if member.is_dir():
+                                continue
+                            #a member that fails part way would leave a broken entry in the tar stream,
+                            #so it is checked in a temporary file first
+                            with tempfile.SpooledTemporaryFile(SPOOL_SIZE, dir=os.path.dirname(os.path.abspath(target))) as spool:
+                                try:
+                                    for chunk in member_chunks(inner, inner_file, member, backend):
+                                        spool.write(chunk)
+                                except (zipfile.error, zlib.error, EOFError, NotImplementedError) as e:
+                                    skipped.append(("%s/%s" % (agency.filename, member.filename), str(e)))
+                                    continue
+                                spool.seek(0)
+                                info = tarfile.TarInfo("%s/%s" % (stem, member.filename))
+                                info.size = member.file_size
+                                info.mtime = zipfile_mtime(member)
+                                tar.addfile(info, spool)
+                            written += member.file_size
+                except (zipfile.error, zlib.error, EOFError, NotImplementedError) as e:
+                    skipped.append((agency.filename, str(e)))
+                finally:
+                    (inner_file.fileobj if isinstance(inner_file, ArchiveSlice) else inner_file).close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    return written
+
+
+def zipfile_mtime(member):
+    """Date modified of a zip member in seconds since the epoch."""
+    return time.mktime(member.date_time + (0, 0, -1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inflate backends and zstd archives for FPDS zip files.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("backends", help="list the inflate backends and whether each is installed")
+    archive = commands.add_parser("recompress", help="write a consolidated year zip file's XML into a .tar.zst")
+    archive.add_argument("consolidated", help="path of FPDS_FYyyyy.zip")
+    archive.add_argument("--target", help="path of the .tar.zst (default: next to the zip file)")
+    archive.add_argument("--level", type=int, default=ZSTD_LEVEL, help="zstd compression level")
+    archive.add_argument("--backend", choices=list(BACKENDS), help="inflate backend (default: %s)" % DEFAULT_BACKEND)
+    args = parser.parse_args()
+    if args.command == "backends":
+        for name, module in BACKENDS.items():
+            print("%-8s %s%s" % (name, "installed" if module else "not installed",
+                " (default)" if name == DEFAULT_BACKEND else ""))
+        print("zstd     %s" % ("installed" if ZSTD_AVAILABLE else "not installed"))
+        return
+    try:
+        target, written, skipped = recompress(args.consolidated, args.target, args.level, args.backend)
+    except ImportError as e:
+        sys.exit(str(e))
+    for name, error in skipped:
+        print("Skipped %s: %s" % (name, error))
+    print("%s: %s XML bytes in %s bytes" % (target, written, os.stat(target).st_size))
+
+
+if __name__ == "__main__":
+    main()
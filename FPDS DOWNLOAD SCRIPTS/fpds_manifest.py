@@ -0,0 +1,320 @@
+# fpds_manifest
+###############################
+# Purpose: Manifests of what was downloaded for each Fiscal Year, and a
+#          command that checks a tree of year folders against them.
+#          fpds_dl.py writes FPDS_manifest_FYyyyy.json into each year folder,
+#          listing every agency zip file and every member unzipped from it
+#          with its size, date modified, md5, sha256 and url.
+#
+# Usage:   python fpds_manifest.py verify D:\data\fpds\downloaded --quick
+#          python fpds_manifest.py verify D:\data\fpds\downloaded --workers 8 --resume
+#          python fpds_manifest.py build D:\data\fpds\downloaded\FPDS_FY2006 2006
+
+import os, re, sys, json, time, zipfile, hashlib, argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+MANIFEST_NAME = "FPDS_manifest_FY%s.json"
+#manifest written by one worker of fpds_coordinator.py, merged into MANIFEST_NAME afterwards
+MANIFEST_PART_NAME = "FPDS_manifest_FY%s.%s.json"
+#progress of the last verify run, so that an interrupted run can be resumed
+PROGRESS_NAME = "FPDS_verify_progress.jsonl"
+#zip files and FAT file systems keep times to 2 seconds
+MTIME_TOLERANCE = 2
+#bytes read at a time when hashing
+HASH_SIZE = 1048576
+
+
+def file_hashes(fileobj):
+    """Return md5 and sha256 of an open binary file, read in one pass.
+    """
+    hash_md5 = hashlib.md5()
+    hash_sha256 = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(HASH_SIZE), b""):
+        hash_md5.update(chunk)
+        hash_sha256.update(chunk)
+    return {'md5': hash_md5.hexdigest(), 'sha256': hash_sha256.hexdigest()}
+
+
+def manifest_path(PATH, year, part=None):
+    """Path of the manifest in a year folder, or of one worker's part of it."""
+    if part:
+        return os.path.join(PATH, MANIFEST_PART_NAME % (year, part))
+    return os.path.join(PATH, MANIFEST_NAME % year)
+
+
+def load_manifest(PATH, year, part=None):
+    """Reads the manifest of a year folder, or starts a new one if there is none.
+
+    Arg:
+            PATH: Year folder.
+            year: Fiscal Year.
+            part: Name of the worker whose part of the manifest to read, or None for the whole manifest.
+    Returns:
+            The manifest dict.
+    """
+    path = manifest_path(PATH, year, part)
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    now = datetime.now().isoformat(timespec='seconds')
+    return {'year': year, 'created': now, 'updated': now, 'consolidated': None, 'archives': {}}
+
+
+def save_manifest(manifest, PATH, part=None):
+    """Writes the manifest of a year folder, or one worker's part of it.
+
+    It is written to a temporary file first and then moved into place, so a crash
+    never leaves a half written manifest behind.
+    """
+    manifest['updated'] = datetime.now().isoformat(timespec='seconds')
+    path = manifest_path(PATH, manifest['year'], part)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def add_archive(manifest, file_name_and_path, u, hashes, members, PATH):
+    """Records one downloaded agency zip file and its members in a manifest.
+
+    Members that were unzipped by PKZip rather than Python have no hashes yet, so they
+    are hashed from the year folder here.
+
+    Arg:
+            manifest: Manifest dict from load_manifest.
+            file_name_and_path: Path of the downloaded zip file.
+            u: Url the zip file came from.
+            hashes: Dict of 'md5' and 'sha256' from fpds_common.download_archive, or None.
+            members: Member dicts from fpds_common.extract_archive.
+            PATH: Year folder the members were unzipped into.
+    Returns:
+            The archive record.
+    """
+    stat = os.stat(file_name_and_path)
+    if hashes is None:
+        with open(file_name_and_path, 'rb') as f:
+            hashes = file_hashes(f)
+    names = [m['name'] for m in members]
+    record = {'url': u, 'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': hashes['md5'], 'sha256': hashes['sha256'],
+        'idv': any(n.endswith("-IDV.xml") for n in names), 'award': any(n.endswith("-AWARD.xml") for n in names),
+        'members': []}
+    for m in members:
+        member = {'name': m['name'], 'size': m['size'], 'mtime': m['mtime'], 'crc': m['crc'],
+            'md5': m['md5'], 'sha256': m['sha256']}
+        target_path = os.path.join(PATH, m['name'])
+        if member['md5'] is None and os.path.isfile(target_path):
+            with open(target_path, 'rb') as f:
+                member.update(file_hashes(f))
+        record['members'].append(member)
+    manifest['archives'][os.path.basename(file_name_and_path)] = record
+    return record
+
+
+def manifest_entries(manifest):
+    """Yields (name, record, is_archive) for every archive and member in a manifest."""
+    for name, archive in sorted(manifest['archives'].items()):
+        yield name, archive, True
+        for member in archive['members']:
+            yield member['name'], member, False
+
+
+def check_entry(PATH, consolidated, name, record, is_archive, quick):
+    """Checks one manifest entry against the year folder.
+
+    Agency zip files that have been moved into the consolidated zip file are checked there.
+
+    Arg:
+            PATH: Year folder.
+            consolidated: Path of the consolidated zip file, or None.
+            name: File name in the manifest.
+            record: Manifest record of the file.
+            is_archive: Whether the entry is an agency zip file rather than an unzipped member.
+            quick: Only compare size and date modified.
+    Returns:
+            A tuple of a status ('ok', 'missing', 'size', 'mtime', 'md5' or 'sha256') and a detail message.
+    """
+    path = os.path.join(PATH, name)
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime
+        def read_hashes():
+            with open(path, 'rb') as f:
+                return file_hashes(f)
+    elif is_archive and consolidated and os.path.isfile(consolidated):
+        with zipfile.ZipFile(consolidated, allowZip64=True) as z:
+            info = {os.path.basename(i.filename): i for i in z.infolist()}.get(name)
+        if info is None:
+            return 'missing', "not in %s" % os.path.basename(consolidated)
+        size, mtime = info.file_size, time.mktime(info.date_time + (0, 0, -1))
+        def read_hashes():
+            with zipfile.ZipFile(consolidated, allowZip64=True) as z, z.open(info) as f:
+                return file_hashes(f)
+    else:
+        return 'missing', "not found"
+    if size != record['size']:
+        return 'size', "%s bytes, manifest has %s" % (size, record['size'])
+    if abs(mtime - record['mtime']) > MTIME_TOLERANCE:
+        return 'mtime', "modified %s, manifest has %s" % (datetime.fromtimestamp(mtime), datetime.fromtimestamp(record['mtime']))
+    if quick or record.get('md5') is None:
+        return 'ok', ""
+    hashes = read_hashes()
+    for kind in ('md5', 'sha256'):
+        if record.get(kind) and hashes[kind] != record[kind]:
+            return kind, "%s %s, manifest has %s" % (kind, hashes[kind], record[kind])
+    return 'ok', ""
+
+
+def find_manifests(root):
+    """Yields (year folder, manifest path) for every manifest under root."""
+    for pathname, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if re.match(MANIFEST_NAME.replace("%s", r"\d+").replace(".", r"\.") + "$", filename):
+                yield pathname, os.path.join(pathname, filename)
+
+
+def verify(root, quick=False, workers=None, resume=False, out=sys.stdout):
+    """Checks every year folder under root against its manifest, several files at a time.
+
+    Results are appended to PROGRESS_NAME in root as they finish. With resume, entries that
+    passed in an earlier run (with hashes, or with the same quick setting) are skipped.
+
+    Arg:
+            root: Folder containing year folders, or a single year folder.
+            quick: Only compare size and date modified.
+            workers: Number of files checked at once; defaults to the number of CPUs.
+            resume: Skip entries that passed in the last run.
+            out: Where failures and the summary are printed.
+    Returns:
+            A list of (manifest path, name, status, detail) for every entry that failed.
+    """
+    progress_path = os.path.join(root, PROGRESS_NAME)
+    passed = set()
+    if resume and os.path.isfile(progress_path):
+        with open(progress_path) as f:
+            for line in f:
+                try:
+                    done = json.loads(line)
+                except ValueError:
+                    continue #last line of a run that was killed mid write
+                if done['status'] == 'ok' and (quick or not done['quick']):
+                    passed.add((done['manifest'], done['name']))
+    failures = []
+    counts = {}
+    with open(progress_path, 'a' if resume else 'w') as progress, ThreadPoolExecutor(workers) as pool:
+        futures = {}
+        for PATH, path in find_manifests(root):
+            with open(path) as f:
+                manifest = json.load(f)
+            consolidated = manifest.get('consolidated') and os.path.join(os.path.dirname(PATH), manifest['consolidated'])
+            key = os.path.relpath(path, root)
+            for name, record, is_archive in manifest_entries(manifest):
+                if (key, name) in passed:
+                    counts['skipped'] = counts.get('skipped', 0) + 1
+                    continue
+                futures[pool.submit(check_entry, PATH, consolidated, name, record, is_archive, quick)] = (key, name)
+        for future in as_completed(futures):
+            key, name = futures[future]
+            try:
+                status, detail = future.result()
+            except (OSError, zipfile.error) as e:
+                status, detail = 'error', repr(e)
+            counts[status] = counts.get(status, 0) + 1
+            progress.write(json.dumps({'manifest': key, 'name': name, 'status': status, 'quick': quick}) + "\n")
+            progress.flush()
+            if status != 'ok':
+                failures.append((key, name, status, detail))
+                out.write("%s\t%s\t%s\t%s\n" % (key, name, status, detail))
+    out.write("%s\n" % ", ".join("%s %s" % (counts[k], k) for k in sorted(counts)))
+    return failures
+
+
+def build(PATH, year, consolidated=None):
+    """Builds a manifest for a year folder downloaded before manifests were written.
+
+    Urls are read from the year's FPDS_DL_log_file.log when it is there. Agency zip files
+    are read from the year folder, or from the consolidated zip file once they have been
+    moved into it.
+
+    Arg:
+            PATH: Year folder.
+            year: Fiscal Year.
+            consolidated: Path of the consolidated zip file; defaults to PATH + ".zip".
+    Returns:
+            The manifest dict, which is also saved.
+    """
+    consolidated = consolidated or PATH + ".zip"
+    manifest = load_manifest(PATH, year)
+    urls = {}
+    log_path = os.path.join(PATH, "FPDS_DL_log_file.log")
+    if os.path.isfile(log_path):
+        with open(log_path) as log:
+            for line in log:
+                if line.startswith("http") and line.strip().endswith(".zip"):
+                    urls[line.strip().rsplit("/", 1)[1]] = line.strip()
+    sources = [(os.path.join(PATH, f), None) for f in sorted(os.listdir(PATH)) if f.endswith("-Archive.zip")]
+    if os.path.isfile(consolidated):
+        manifest['consolidated'] = os.path.basename(consolidated)
+        with zipfile.ZipFile(consolidated, allowZip64=True) as z:
+            sources += [(None, i) for i in z.infolist() if i.filename.endswith("-Archive.zip")]
+    for path, info in sources:
+        infos = []
+        try:
+            if info is None:
+                name, size, mtime = os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime
+                with open(path, 'rb') as f:
+                    hashes = file_hashes(f)
+                with zipfile.ZipFile(path, allowZip64=True) as z:
+                    infos = z.infolist()
+            else:
+                name, size, mtime = os.path.basename(info.filename), info.file_size, time.mktime(info.date_time + (0, 0, -1))
+                with zipfile.ZipFile(consolidated, allowZip64=True) as outer, outer.open(info) as f:
+                    hashes = file_hashes(f)
+                with zipfile.ZipFile(consolidated, allowZip64=True) as outer, outer.open(info) as f, \
+                        zipfile.ZipFile(f) as z:
+                    infos = z.infolist()
+        except zipfile.error as e:
+            #a zip file that cannot be read is still recorded, with no members
+            print("%s is not a zip file: %s" % (name, e))
+        members = []
+        for i in infos:
+            if i.is_dir():
+                continue
+            member = {'name': i.filename, 'size': i.file_size, 'crc': i.CRC,
+                'mtime': time.mktime(i.date_time + (0, 0, -1)), 'md5': None, 'sha256': None}
+            if os.path.isfile(os.path.join(PATH, i.filename)):
+                with open(os.path.join(PATH, i.filename), 'rb') as f:
+                    member.update(file_hashes(f))
+            members.append(member)
+        manifest['archives'][name] = {'url': urls.get(name), 'size': size, 'mtime': mtime,
+            'md5': hashes['md5'], 'sha256': hashes['sha256'],
+            'idv': any(m['name'].endswith("-IDV.xml") for m in members),
+            'award': any(m['name'].endswith("-AWARD.xml") for m in members), 'members': members}
+    save_manifest(manifest, PATH)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write and check FPDS download manifests.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    check = commands.add_parser("verify", help="check year folders against their manifests")
+    check.add_argument("root", help="folder containing FPDS_FYyyyy year folders, or one year folder")
+    check.add_argument("--quick", action="store_true", help="only compare size and date modified")
+    check.add_argument("--workers", type=int, help="files checked at once (default: number of CPUs)")
+    check.add_argument("--resume", action="store_true", help="skip files that passed in the last run")
+    make = commands.add_parser("build", help="write a manifest for a year folder downloaded without one")
+    make.add_argument("path", help="year folder")
+    make.add_argument("year", type=int, help="Fiscal Year")
+    make.add_argument("--consolidated", help="consolidated zip file (default: the year folder + .zip)")
+    args = parser.parse_args()
+    if args.command == "verify":
+        failures = verify(args.root, args.quick, args.workers, args.resume)
+        sys.exit(1 if failures else 0)
+    manifest = build(os.path.normpath(args.path), args.year, args.consolidated)
+    print("%s archives written to %s" % (len(manifest['archives']), manifest_path(os.path.normpath(args.path), args.year)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+# fpds_mock_server
+###############################
+# Purpose: Local stand-in for the FPDS download site, so the download scripts
+#          can be run and timed without fpds.gov.
+#          Serves directory_browser/index.php pages laid out like the real ones
+#          and synthetic agency ZIP files named with the pre-2015 and post-2015
+#          suffix schemes. Archives can be forced to ZIP64 or made malformed, and
+#          responses can be delayed, bandwidth limited or refused as busy.
+#
+# Usage:   python fpds_mock_server.py --years 2006 2016 --agencies 10 --size 5
+#          then pass the printed url as --base-url to fpds_dl.py, fpds_coordinator.py
+#          or fpds_diff.py (or set fpds_common.FPDS_URL to it in a script).
+
+import os, re, time, zipfile, random, argparse, threading
+from datetime import datetime
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, unquote
+
+from fpds_common import archive_suffix, archive_urls
+
+#agency IDs used before falling back to made up ones; OTHER_DOD_AGENCIES exercises the special case url
+AGENCY_IDS = ['0300-LIBRARYOFCONGRESS', '1100-EXECUTIVEOFFICEOFTHEPRESIDENT', '1200-AGRICULTUREDEPARTMENTOF',
+    '1300-COMMERCEDEPARTMENTOF', '1700-DEPARTMENTOFTHENAVY', '19BM-INTERNATIONALBOUNDARYANDWATERCOMMISSION-US-MEXICO',
+    '2100-DEPARTMENTOFTHEARMY', '3600-VETERANSAFFAIRSDEPARTMENTOF', '4700-GENERALSERVICESADMINISTRATION',
+    '5700-DEPARTMENTOFTHEAIRFORCE', '7000-HOMELANDSECURITYDEPARTMENTOF', '8900-ENERGYDEPARTMENTOF',
+    '97AS-DEFENCELOGISTICSAGENCY', 'OTHER_DOD_AGENCIES']
+#ways an archive can be broken
+MALFORMED_KINDS = ('truncated', 'corrupt', 'notzip')
+#bytes written to the socket at a time
+BLOCK_SIZE = 65536
+
+RECORD = ('<award><awardID><PIID>%s%08d</PIID><modNumber>%d</modNumber></awardID>'
+    '<relevantContractDates><signedDate>%s-%02d-%02d 00:00:00</signedDate></relevantContractDates>'
+    '<dollarValues><obligatedAmount>%d.%02d</obligatedAmount></dollarValues>'
+    '<vendor><vendorName>VENDOR %05d</vendorName><DUNSNumber>%09d</DUNSNumber></vendor>'
+    '<productOrServiceInformation><productOrServiceCode>%s</productOrServiceCode></productOrServiceInformation>'
+    '</award>\n')
+
+
+def year_folder(year):
+    """Gets the FPDS folder name for a Fiscal Year, e.g. FY13-V1.4.
+
+    FY16 seprates with a _ instead of a -, like the real site.
+    """
+    return "FY%s%sV1.4" % (str(year)[-2:], "_" if year == 2016 else "-")
+
+
+def synthetic_xml(out, agency, year, size, rng):
+    """Writes about size bytes of FPDS-like award XML to an open binary file.
+
+    Records vary enough that the XML compresses about as well as real FPDS data.
+    """
+    out.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<awards>\n')
+    written = 0
+    n = 0
+    while written < size:
+        lines = []
+        for i in range(256):
+            n += 1
+            lines.append(RECORD % (agency[:4], n, rng.randrange(10), year-1, rng.randrange(1, 13), rng.randrange(1, 29),
+                rng.randrange(10**7), rng.randrange(100), rng.randrange(10**5), rng.randrange(10**9),
+                rng.choice(('R425', 'D399', '7030', 'S206', 'J099'))))
+        block = "".join(lines).encode('ascii')
+        out.write(block)
+        written += len(block)
+    out.write(b'</awards>\n')
+
+
+def build_archive(path, agency, stem, year, size, zip64=False, malformed=None, seed=0):
+    """Writes one synthetic agency ZIP file.
+
+    Arg:
+            path: Where to write the ZIP file.
+            agency: Agency ID.
+            stem: File name without "-Archive.zip", used to name the members.
+            year: Fiscal Year.
+            size: Uncompressed XML bytes in the archive, split between AWARD and IDV members.
+            zip64: Force ZIP64 headers on every member.
+            malformed: One of MALFORMED_KINDS, or None for a good archive.
+            seed: Random seed, so the same settings always build the same bytes.
+    Returns:
+            Nothing. Saves the file.
+    """
+    rng = random.Random("%s-%s-%s" % (seed, year, agency))
+    if malformed == 'notzip':
+        with open(path, 'w') as f:
+            f.write("<html><head><title>Object not found!</title></head><body></body></html>\n")
+        return
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for kind, share in (("AWARD", 0.7), ("IDV", 0.3)):
+            info = zipfile.ZipInfo("%s-%s.xml" % (stem, kind), date_time=(year-1, 10, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(info, 'w', force_zip64=zip64) as member:
+                synthetic_xml(member, agency, year, int(size*share), rng)
+    if malformed == 'truncated':
+        #cut off the central directory and the end of the last member
+        length = os.stat(path).st_size
+        with open(path, 'r+b') as f:
+            f.truncate(int(length*0.9))
+    elif malformed == 'corrupt':
+        #scribble over the compressed data of the first member
+        with open(path, 'r+b') as f:
+            f.seek(200)
+            f.write(bytes(rng.randrange(256) for i in range(64)))
+
+
+class _Server(ThreadingHTTPServer):
+    #the default backlog of 5 drops connections when hundreds of probes arrive at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class MockFPDS:
+    """A synthetic FPDS download site.
+
+    Arg:
+            data_dir: Folder the synthetic archives are built in.
+            years: Fiscal Years to publish.
+            agencies: Number of agency archives per year.
+            sizes: Uncompressed XML bytes per archive; cycled through across agencies.
+            zip64: Force ZIP64 headers in every archive.
+            malformed: Number of archives per year (from the end of the list) that are broken.
+            latency: Seconds to wait before answering each request.
+            throttle: Bytes per second per connection, or None for no limit.
+            busy_every: Answer every Nth archive request with 503, or 0 never to.
+    """
+
+    def __init__(self, data_dir, years, agencies=5, sizes=(1000000,), zip64=False, malformed=0,
+                 latency=0.0, throttle=None, busy_every=0, seed=0):
+        self.data_dir = data_dir
+        self.years = sorted(years)
+        self.agencies = agencies
+        self.sizes = list(sizes)
+        self.zip64 = zip64
+        self.malformed = malformed
+        self.latency = latency
+        self.throttle = throttle
+        self.busy_every = busy_every
+        self.seed = seed
+        #map of url path to file on disk, filled in by build
+        self.files = {}
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def agency_ids(self):
+        """Gets the agency IDs published each year."""
+        ids = AGENCY_IDS[:-1][:max(self.agencies-1, 0)]
+        ids += ["%04d-SYNTHETICAGENCY%s" % (9000+i, i) for i in range(self.agencies-1-len(ids))]
+        if self.agencies:
+            ids.append(AGENCY_IDS[-1])
+        return sorted(ids)
+
+    def build(self):
+        """Builds every synthetic archive, replacing any left in data_dir by an earlier run."""
+        for year in self.years:
+            folder = year_folder(year)
+            links = self.agency_ids()
+            urls = archive_urls(links, "/ddps/%s/" % folder, archive_suffix(year))
+            for i, (agency, u) in enumerate(zip(links, urls)):
+                path = os.path.join(self.data_dir, folder, agency, u.rsplit("/", 1)[1])
+                self.files[u] = path
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                kind = None
+                if i >= len(links) - self.malformed:
+                    kind = MALFORMED_KINDS[(len(links)-1-i) % len(MALFORMED_KINDS)]
+                build_archive(path, agency, os.path.basename(path)[:-len("-Archive.zip")], year,
+                    self.sizes[i % len(self.sizes)], self.zip64, kind, self.seed)
+
+    def root_page(self):
+        """Html of the directory of all years."""
+        rows = ['<tr><td><img src="images/folder.gif"></td><td><a href="?somepath=..%%2F%s&n=2">%s</a></td></tr>'
+            % (year_folder(y), year_folder(y)) for y in self.years]
+        return "<html><body><table>\n%s\n</table></body></html>\n" % "\n".join(rows)
+
+    def year_page(self, folder):
+        """Html of the directory of agencies for one year."""
+        rows = ['<tr><td><img src="images/folder.gif"></td><td><a href="?somepath=..%%2F%s%%2F%s&n=4" id="4%s">%s</a></td></tr>'
+            % (folder, a, a, a) for a in self.agency_ids()]
+        return "<html><body><table>\n%s\n</table></body></html>\n" % "\n".join(rows)
+
+    def start(self, port=0):
+        """Starts serving in a background thread.
+
+        Returns:
+            The url to pass as base_url or --base-url in place of fpds_common.FPDS_URL.
+        """
+        if not self.files:
+            self.build()
+        self._server = _Server(("127.0.0.1", port), _handler(self))
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:%s/ddps/" % self._server.server_address[1]
+
+    def stop(self):
+        """Stops serving."""
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def _handler(mock):
+    """Makes the request handler class for a MockFPDS."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_HEAD(self):
+            self.respond(body=False)
+
+        def do_GET(self):
+            self.respond(body=True)
+
+        def send_text(self, status, text, body):
+            data = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if body:
+                self.wfile.write(data)
+
+        def respond(self, body):
+            with mock._lock:
+                mock.requests += 1
+                count = mock.requests
+            if mock.latency:
+                time.sleep(mock.latency)
+            parts = urlsplit(self.path)
+            if parts.path == "/ddps/directory_browser/index.php":
+                somepath = unquote(re.sub("^somepath=", "", parts.query.split("&")[0]))
+                folder = somepath.replace("../", "").strip("/")
+                if not folder:
+                    return self.send_text(200, mock.root_page(), body)
+                if folder in [year_folder(y) for y in mock.years]:
+                    return self.send_text(200, mock.year_page(folder), body)
+                return self.send_text(404, "<title>Object not found!</title>", body)
+            path = mock.files.get(parts.path)
+            if path is None:
+                return self.send_text(404, "<html><head><title>Object not found!</title></head></html>", body)
+            if mock.busy_every and count % mock.busy_every == 0:
+                return self.send_text(503, "<title>Service Unavailable</title>", body)
+            self.send_file(path, body)
+
+        def send_file(self, path, body):
+            length = os.stat(path).st_size
+            start, end = 0, length-1
+            match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+            if match and match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+            elif match and match.group(2):
+                #suffix range: the last N bytes
+                start = max(0, length - int(match.group(2)))
+            if match and match.group(1) and start >= length:
+                #nothing left to send from there, as when a resumed download was already whole
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%s" % length)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if match and start <= end:
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, length))
+            else:
+                start, end = 0, length-1
+                self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(end-start+1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified", formatdate(os.stat(path).st_mtime, usegmt=True))
+            self.end_headers()
+            if not body:
+                return
+            began = time.time()
+            sent = 0
+            with open(path, 'rb') as f:
+                f.seek(start)
+                for block in iter(lambda: f.read(min(BLOCK_SIZE, end+1-start-sent)), b""):
+                    try:
+                        self.wfile.write(block)
+                    except (BrokenPipeError, ConnectionResetError):
+                        break
+                    sent += len(block)
+                    if mock.throttle:
+                        #sleep until the connection is back under its bandwidth limit
+                        ahead = sent/mock.throttle - (time.time()-began)
+                        if ahead > 0:
+                            time.sleep(ahead)
+            with mock._lock:
+                mock.bytes_sent += sent
+
+    return Handler
+
+
+def add_arguments(parser):
+    """Adds the mock site settings to an argparse parser."""
+    parser.add_argument("--years", type=int, nargs="+", default=[2006, 2016], help="Fiscal Years to publish")
+    parser.add_argument("--agencies", type=int, default=5, help="agency archives per year")
+    parser.add_argument("--size", type=float, nargs="+", default=[1.0], help="uncompressed MB per archive, cycled across agencies")
+    parser.add_argument("--zip64", action="store_true", help="force ZIP64 headers in every archive")
+    parser.add_argument("--malformed", type=int, default=0, help="broken archives per year")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each response")
+    parser.add_argument("--throttle", type=float, default=0.0, help="MB/s per connection, 0 for no limit")
+    parser.add_argument("--busy-every", type=int, default=0, help="answer every Nth archive request with 503")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def from_arguments(args, data_dir):
+    """Makes a MockFPDS from parsed add_arguments settings."""
+    return MockFPDS(data_dir, args.years, args.agencies, [int(s*1000000) for s in args.size], args.zip64,
+        args.malformed, args.latency, args.throttle*1000000 or None, args.busy_every, args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic FPDS download site on localhost.")
+    parser.add_argument("--data-dir", default="fpds_mock_data", help="folder to build archives in")
+    parser.add_argument("--port", type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    mock = from_arguments(args, args.data_dir)
+    print("[%s] Building archives in %s" % (datetime.now().strftime('%m/%d/%Y %I:%M:%S %p'), args.data_dir))
+    mock.build()
+    print("Serving %s (Ctrl+C to stop)" % mock.start(args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        mock.stop()
@@ -0,0 +1,183 @@
+# fpds_space
+###############################
+# Purpose: Disk space planning for fpds_dl.py's low disk mode.
+#          Before an agency zip file is downloaded, its size is read from the
+#          server's Content-Length and its unzipped size from the zip file's
+#          central directory (fetched with a Range request), and that much
+#          space is held in a reservation file in the year folder. The
+#          reservation is shrunk just before each stage writes its data, so a
+#          full drive is found before an archive is started, not halfway through.
+
+import os, errno, struct, shutil, requests
+
+from fpds_common import TIMEOUT
+
+#file in the year folder that holds the reserved space
+RESERVATION_NAME = "FPDS_space_reservation.tmp"
+#bytes left free on the drive on top of what an archive needs
+MARGIN = 100000000
+#unzipped bytes assumed per zipped byte when the central directory cannot be read
+UNPACKED_RATIO = 15
+#bytes fetched from the end of a zip file to find its central directory
+TAIL_SIZE = 65536
+
+#zip record signatures
+EOCD = b"PK\x05\x06"
+EOCD64_LOCATOR = b"PK\x06\x07"
+CENTRAL_HEADER = b"PK\x01\x02"
+
+
+def fetch_range(u, start, end=None):
+    """Gets bytes start to end (inclusive) of a url, or None if the server does not serve ranges."""
+    request = requests.get(u, headers={'Range': "bytes=%s-%s" % (start, "" if end is None else end)}, stream=True, timeout=TIMEOUT)
+    try:
+        if request.status_code != 206:
+            return None
+        return request.content
+    finally:
+        request.close()
+
+
+def central_directory_size(tail, tail_start, fetch):
+    """Sums the unzipped size of every member listed in a zip file's central directory.
+
+    Arg:
+            tail: The last bytes of the zip file.
+            tail_start: Offset of tail in the zip file.
+            fetch: Function (start, end) returning other bytes of the zip file, used when
+                   the central directory does not fit in tail.
+    Returns:
+            Total unzipped bytes, or None if the zip file's end records could not be found.
+    """
+    at = tail.rfind(EOCD)
+    if at < 0 or len(tail) < at + 22:
+        return None
+    entries, cd_size, cd_offset = struct.unpack("<xxxxxxHII", tail[at+4:at+20])[0:3]
+    locator = at - 20
+    if (cd_offset == 0xFFFFFFFF or cd_size == 0xFFFFFFFF or entries == 0xFFFF) and locator >= 0 \
+            and tail[locator:locator+4] == EOCD64_LOCATOR:
+        #ZIP64 end of central directory record holds the real sizes
+        eocd64 = struct.unpack("<Q", tail[locator+8:locator+16])[0]
+        record = tail[eocd64-tail_start:eocd64-tail_start+56] if eocd64 >= tail_start else fetch(eocd64, eocd64+55)
+        if record is None or len(record) < 56:
+            return None
+        entries, cd_size, cd_offset = struct.unpack("<QQQ", record[32:56])
+    if cd_offset >= tail_start:
+        directory = tail[cd_offset-tail_start:cd_offset-tail_start+cd_size]
+    else:
+        directory = fetch(cd_offset, cd_offset+cd_size-1)
+    if directory is None:
+        return None
+    total = 0
+    at = 0
+    while directory[at:at+4] == CENTRAL_HEADER:
+        size, name_length, extra_length, comment_length = struct.unpack("<IHHH", directory[at+24:at+34])
+        if size == 0xFFFFFFFF:
+            #the real size is the first field of the ZIP64 extra field
+            extra = directory[at+46+name_length:at+46+name_length+extra_length]
+            while len(extra) >= 4:
+                tag, length = struct.unpack("<HH", extra[:4])
+                if tag == 1:
+                    size = struct.unpack("<Q", extra[4:12])[0]
+                    break
+                extra = extra[4+length:]
+        total += size
+        at += 46 + name_length + extra_length + comment_length
+    return total
+
+
+def remote_archive_size(u):
+    """Estimates the space an agency zip file needs before it is downloaded.
+
+    Arg:
+            u: Url of the zip file.
+    Returns:
+            A tuple of the zip file's size and its unzipped size. The unzipped size is read from
+            the central directory when the server serves ranges, otherwise it is estimated with
+            UNPACKED_RATIO. Both are None if the server does not give a Content-Length or cannot
+            be reached, leaving the download, which tries twice, to find out why.
+    """
+    try:
+        head = requests.head(u, allow_redirects=True, timeout=TIMEOUT)
+        if head.status_code != 200 or 'Content-Length' not in head.headers:
+            return None, None
+        length = int(head.headers['Content-Length'])
+        tail_start = max(0, length - TAIL_SIZE)
+        tail = fetch_range(u, tail_start)
+        unpacked = None
+        if tail is not None:
+            try:
+                unpacked = central_directory_size(tail, tail_start, lambda start, end: fetch_range(u, start, end))
+            except struct.error:
+                unpacked = None
+    except requests.exceptions.RequestException:
+        return None, None
+    if unpacked is None:
+        unpacked = length * UNPACKED_RATIO
+    return length, unpacked
+
+
+class Reservation:
+    """Space held in a year folder for the stages of one archive that have not run yet.
+
+    Arg:
+            PATH: Year folder.
+            margin: Bytes to leave free on the drive on top of what an archive needs.
+    """
+
+    def __init__(self, PATH, margin=MARGIN):
+        self.path = os.path.join(PATH, RESERVATION_NAME)
+        self.margin = margin
+        self.stages = {}
+        #a run that crashed leaves its reservation file behind, still holding space this one can use
+        self.held = os.stat(self.path).st_size if os.path.isfile(self.path) else 0
+
+    def _resize(self, size):
+        with open(self.path, 'r+b' if os.path.isfile(self.path) else 'w+b') as f:
+            if size > self.held and hasattr(os, 'posix_fallocate'):
+                #truncate would only make a sparse file here, which holds no space
+                os.posix_fallocate(f.fileno(), 0, size)
+            f.truncate(size)
+        self.held = size
+
+    def plan(self, u, logfile):
+        """Estimates the space one archive needs and reserves it.
+
+        The archive needs room to be downloaded, unzipped and then copied into the consolidated
+        zip file before it is deleted.
+
+        Arg:
+                u: Url of the zip file.
+                logfile: Open log file.
+        Returns:
+                Nothing.
+        Raises:
+                OSError: errno ENOSPC if the drive does not have room for the archive.
+        """
+        length, unpacked = remote_archive_size(u)
+        if length is None:
+            #nothing to plan for; the download will log why the file could not be retrieved
+            self.stages = {}
+            self._resize(0)
+            return
+        self.stages = {'download': length, 'extract': unpacked, 'consolidate': length}
+        need = sum(self.stages.values())
+        free = shutil.disk_usage(os.path.dirname(self.path)).free + self.held
+        logfile.write("Space needed for %s: %s bytes zipped, %s bytes unzipped. %s bytes free.\n" % (u, length, unpacked, free))
+        if need + self.margin > free:
+            self.stages = {}
+            self.close()
+            logfile.write("ERROR: Not enough disk space for %s\n" % u)
+            raise OSError(errno.ENOSPC, "Not enough disk space for %s: %s bytes needed, %s bytes free" % (u, need + self.margin, free))
+        self._resize(need)
+
+    def release(self, stage):
+        """Gives back the space held for a stage, just before that stage writes its data."""
+        if stage in self.stages:
+            self._resize(max(0, self.held - self.stages.pop(stage)))
+
+    def close(self):
+        """Gives back all reserved space."""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.held = 0
@@ -0,0 +1,289 @@
+# fpds_telemetry
+###############################
+# Purpose: Live progress for long FPDS runs.
+#          A Telemetry object counts the bytes of each agency zip file as it
+#          downloads, and how many zip files are queued, in flight, done, failed
+#          or retried. A background thread samples those counters every few
+#          seconds, works out MB/s and the time left in the year and in the whole
+#          run of years, and writes them to a JSON
+#          status file (replaced atomically, so it is never half written). Given a
+#          port, it also serves them as Prometheus text on localhost. The download
+#          loops only add each chunk's length to a counter, so sampling never
+#          slows them down.
+#
+# Usage:   python fpds_dl.py --metrics-port 9108       (status file FPDS_status.json is written next to the year folders)
+#          python fpds_telemetry.py D:\data\fpds\downloaded\FPDS_status.json     (follow a status file in the console)
+
+import os, sys, json, time, argparse, threading, collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+STATUS_NAME = "FPDS_status.json"
+STATUS_PART_NAME = "FPDS_status.%s.json"
+#seconds between samples
+INTERVAL = 5
+#weight of the newest sample in the smoothed download rate
+SMOOTHING = 0.3
+#seconds without a new byte before downloads in flight count as stalled
+STALL = 60
+#finished zip files kept in the status file
+RECENT = 20
+
+
+class Progress:
+    """Counters for one agency zip file. The download loop only adds to done."""
+    __slots__ = ('url', 'name', 'year', 'total', 'done', 'started', 'retries')
+
+    def __init__(self, url, year, total):
+        self.url = url
+        self.name = url.rstrip("/").split("/")[-1]
+        self.year = year
+        self.total = total
+        self.done = 0
+        self.started = time.time()
+        self.retries = 0
+
+    def as_dict(self, now, ok=None):
+        seconds = max(now - self.started, 1e-6)
+        row = {'name': self.name, 'year': self.year, 'bytes': self.done, 'total': self.total,
+            'seconds': round(seconds, 1), 'MB/s': round(self.done/seconds/1000000, 3), 'retries': self.retries}
+        if ok is not None:
+            row['ok'] = ok
+        return row
+
+
+class Telemetry:
+    """Progress, throughput and time left for one run.
+
+    Arg:
+            status_path: JSON status file to write every interval seconds.
+            interval: Seconds between samples.
+            port: Port on 127.0.0.1 to serve Prometheus text on, or None for no endpoint.
+    """
+
+    def __init__(self, status_path, interval=INTERVAL, port=None):
+        self.status_path = status_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.year = None
+        self.stage = "starting"
+        self.planned = 0
+        self.queued = 0
+        self.active = {}
+        self.finished = 0
+        self.failed = 0
+        self.retries = 0
+        self.finished_bytes = 0
+        #years of the run, and bytes downloaded in each year finished so far
+        self.years = None
+        self.year_bytes = []
+        self._year_start = 0
+        self.recent = collections.deque(maxlen=RECENT)
+        self.rate = None
+        self.status = {}
+        self._sampled = (self.started, 0)
+        self._last_byte = self.started
+        self._stop = threading.Event()
+        self._server = None
+        if port is not None:
+            self._server = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def plan_run(self, years):
+        """Sets how many years the run will download, for the time left in the whole run."""
+        self.years = len(years)
+
+    def finish_year(self):
+        """Records the bytes downloaded in the year just finished."""
+        with self.lock:
+            done = self.finished_bytes + sum(p.done for p in self.active.values())
+        self.year_bytes.append(done - self._year_start)
+        self._year_start = done
+
+    def plan(self, year, urls):
+        """Adds a year's zip file urls to the queue."""
+        with self.lock:
+            self.year = year
+            self.planned += len(urls)
+            self.queued += len(urls)
+
+    def start(self, u, total=None):
+        """Marks a zip file as in flight, or restarts its counters if it is being retried.
+
+        Arg:
+                u: Url of the zip file.
+                total: Its Content-Length, if the server sent one.
+        Returns:
+                The Progress whose done the download loop adds each chunk's length to.
+        """
+        with self.lock:
+            progress = self.active.get(u)
+            if progress is None:
+                self.queued -= 1
+                progress = self.active[u] = Progress(u, self.year, total)
+            else:
+                progress.done = 0
+                progress.total = total
+            return progress
+
+    def retry(self, u):
+        """Counts a request that is being tried again."""
+        with self.lock:
+            self.retries += 1
+            if u in self.active:
+                self.active[u].retries += 1
+
+    def finish(self, u, ok):
+        """Marks a zip file as saved (ok) or failed."""
+        with self.lock:
+            progress = self.active.pop(u, None)
+            if progress is None:
+                #failed before the server answered
+                self.queued -= 1
+                progress = Progress(u, self.year, None)
+            self.finished_bytes += progress.done
+            if ok:
+                self.finished += 1
+            else:
+                self.failed += 1
+            self.recent.append(progress.as_dict(time.time(), ok))
+
+    def sample(self):
+        """Works out rates and the time left from the counters.
+
+        Returns:
+                The status dict written to the status file.
+        """
+        now = time.time()
+        with self.lock:
+            active = list(self.active.values())
+            done = self.finished_bytes + sum(p.done for p in active)
+            recent = list(self.recent)
+            queued, finished, failed = self.queued, self.finished, self.failed
+        then, before = self._sampled
+        if now > then:
+            current = (done - before)/(now - then)
+            self.rate = current if self.rate is None else SMOOTHING*current + (1 - SMOOTHING)*self.rate
+        if done != before:
+            self._last_byte = now
+        self._sampled = (now, done)
+        #zip files not started yet are assumed to be the average size of those finished
+        sizes = [row['bytes'] for row in recent if row.get('ok')]
+        average = sum(sizes)/len(sizes) if sizes else None
+        remaining = sum(max(p.total - p.done, 0) for p in active if p.total) + queued*(average or 0)
+        eta = remaining/self.rate if self.rate and (average or not queued) else None
+        #years not started yet are assumed to be the size of those finished, or of this one until one has
+        run_eta = None
+        if eta is not None and self.years:
+            later = max(self.years - len(self.year_bytes) - 1, 0)
+            year_size = sum(self.year_bytes)/len(self.year_bytes) if self.year_bytes else done - self._year_start + remaining
+            run_eta = eta + later*year_size/self.rate
+        self.status = {
+            'updated': now, 'started': self.started, 'year': self.year, 'stage': self.stage,
+            'archives': {'planned': self.planned, 'queued': queued, 'active': len(active), 'done': finished, 'failed': failed},
+            'retries': self.retries, 'bytes': done, 'bytes_remaining': int(remaining),
+            'MB/s': round((self.rate or 0)/1000000, 3), 'average_MB/s': round(done/max(now - self.started, 1e-6)/1000000, 3),
+            'eta_seconds': None if eta is None else round(eta), 'run_eta_seconds': None if run_eta is None else round(run_eta),
+            'years': {'planned': self.years, 'done': len(self.year_bytes)}, 'stalled': bool(active) and now - self._last_byte > STALL,
+            'in_flight': [p.as_dict(now) for p in active], 'recent': recent}
+        return self.status
+
+    def write(self):
+        """Samples the counters and replaces the status file."""
+        status = self.sample()
+        tmp = self.status_path + ".tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(status, f, indent=1)
+            os.replace(tmp, self.status_path)
+        except OSError:
+            #a reader holding the file open on Windows; the next sample will try again
+            pass
+
+    def prometheus(self):
+        """The last sample as Prometheus text."""
+        status = self.status or self.sample()
+        lines = [
+            "# TYPE fpds_bytes_downloaded_total counter", "fpds_bytes_downloaded_total %s" % status['bytes'],
+            "# TYPE fpds_bytes_remaining gauge", "fpds_bytes_remaining %s" % status['bytes_remaining'],
+            "# TYPE fpds_download_rate_bytes gauge", "fpds_download_rate_bytes %s" % int(status['MB/s']*1000000),
+            "# TYPE fpds_retries_total counter", "fpds_retries_total %s" % status['retries'],
+            "# TYPE fpds_stalled gauge", "fpds_stalled %s" % int(status['stalled']),
+            "# TYPE fpds_archives gauge"]
+        lines += ['fpds_archives{state="%s"} %s' % item for item in status['archives'].items()]
+        if status['eta_seconds'] is not None:
+            lines += ["# TYPE fpds_eta_seconds gauge", "fpds_eta_seconds %s" % status['eta_seconds']]
+        if status['run_eta_seconds'] is not None:
+            lines += ["# TYPE fpds_run_eta_seconds gauge", "fpds_run_eta_seconds %s" % status['run_eta_seconds']]
+        lines.append("# TYPE fpds_archive_bytes gauge")
+        lines += ['fpds_archive_bytes{archive="%s"} %s' % (row['name'], row['bytes']) for row in status['in_flight']]
+        return "\n".join(lines) + "\n"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def close(self):
+        """Writes the final status and stops sampling and serving."""
+        self._stop.set()
+        self._thread.join()
+        self.stage = "finished"
+        self.write()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _handler(telemetry):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = telemetry.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+def describe(status):
+    """One console line for a status dict."""
+    a = status['archives']
+    hms = lambda eta: "unknown" if eta is None else "%d:%s" % (eta//3600, time.strftime("%M:%S", time.gmtime(eta)))
+    run = ""
+    if status.get('years', {}).get('planned'):
+        run = ", run (year %s of %s) ETA %s" % (status['years']['done'] + 1, status['years']['planned'], hms(status['run_eta_seconds']))
+    return "[%s] FY%s %s: %s/%s done, %s failed, %s in flight, %s queued, %s retries, %.1f MB, %s MB/s, year ETA %s%s%s" % (
+        time.strftime("%H:%M:%S", time.localtime(status['updated'])), status['year'], status['stage'], a['done'],
+        a['planned'], a['failed'], a['active'], a['queued'], status['retries'], status['bytes']/1000000, status['MB/s'],
+        hms(status['eta_seconds']), run, " STALLED" if status['stalled'] else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow an FPDS status file.")
+    parser.add_argument("status", help="status file written by fpds_dl.py or fpds_coordinator.py")
+    parser.add_argument("--interval", type=float, default=INTERVAL, help="seconds between reads")
+    args = parser.parse_args()
+    updated = None
+    while True:
+        try:
+            with open(args.status) as f:
+                status = json.load(f)
+        except (OSError, ValueError) as e:
+            sys.exit("Can't read %s: %s" % (args.status, e))
+        if status['updated'] != updated:
+            print(describe(status))
+            updated = status['updated']
+        if status['stage'] == "finished":
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# fpds_transport
+###############################
+# Purpose: Concurrent HTTP for the FPDS scripts behind one interface.
+#          probe(urls) asks the server for the status of many urls at once, head(urls)
+#          for their status, size and date modified, and
+#          download(urls, PATH, logfile) saves many agency zip files at once,
+#          hashing and logging each one the way fpds_common.download_archive does.
+#          ThreadedTransport uses requests in a thread pool. AsyncTransport uses
+#          asyncio with aiohttp (pip install aiohttp): one thread handles every
+#          connection, with pooled connections, a per-host limit and timeouts, and
+#          body chunks are written and hashed on a small file writer thread pool.
+
+import os, re, asyncio, hashlib, threading, requests
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from fpds_common import dtime, TIMEOUT
+
+#bytes read from the server per chunk
+CHUNK_SIZE = 262144
+
+
+def log_result(logfile, u, file_name_and_path, status, hashes, error=None):
+    """Logs one download in the same format as fpds_common.download_archive."""
+    fname = os.path.basename(file_name_and_path)
+    if error is not None:
+        logfile.write("Can't retrieve %s: %s\n" % (u, error))
+        print("Can't retrieve %s: %s" % (u, error))
+        return
+    if status != 200:
+        logfile.write("%s Can't retrieve %s\n" % (status, u))
+        print("%s Can't retrieve %s" % (status, u))
+    if os.path.isfile(file_name_and_path):
+        hash_text = " md5: %s" % hashes['md5'] if hashes else "hash not updated succesfully"
+        logfile.write("[%s] Saved %s\t%s bytes. %s\n" % (dtime(file_name_and_path), fname, os.stat(file_name_and_path).st_size, hash_text))
+    else:
+        logfile.write("File %s not saved\n" % u)
+
+
+def head_metadata(status, headers):
+    """Reads the status, Content-Length and Last-Modified (as a timestamp) of a HEAD response."""
+    last_modified = headers.get('Last-Modified')
+    try:
+        last_modified = parsedate_to_datetime(last_modified).timestamp() if last_modified else None
+    except (TypeError, ValueError):
+        last_modified = None
+    size = headers.get('Content-Length')
+    return {'status': status, 'size': int(size) if size and size.isdigit() else None, 'last_modified': last_modified}
+
+
+def target_path(u, PATH):
+    """Path a zip file url is saved to in a year folder."""
+    return os.path.join(PATH, re.search("([^/]+$)",u).group(0))
+
+
+class ThreadedTransport:
+    """Probes and downloads with requests, several urls at a time on a thread pool.
+
+    Arg:
+            workers: Urls handled at once.
+            chunk_size: Bytes read from the server per chunk.
+            timeout: Seconds to wait for the server to connect or send more data.
+    """
+    name = "threads"
+
+    def __init__(self, workers=16, chunk_size=CHUNK_SIZE, timeout=TIMEOUT):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        #one pooled session per thread, since requests sessions are not thread safe
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+            self._local.session.mount("http://", HTTPAdapter(pool_maxsize=self.workers))
+            self._local.session.mount("https://", HTTPAdapter(pool_maxsize=self.workers))
+        return self._local.session
+
+    def _head(self, u):
+        try:
+            response = self._session().head(u, timeout=self.timeout, allow_redirects=True)
+            return head_metadata(response.status_code, response.headers)
+        except requests.exceptions.RequestException:
+            return None
+
+    def head(self, urls):
+        """Gets the status, size and date modified of each url.
+
+        Returns:
+                A dict of url to a dict of 'status', 'size' and 'last_modified' (None if not
+                sent), or to None if the url could not be reached.
+        """
+        with ThreadPoolExecutor(self.workers) as pool:
+            return dict(zip(urls, pool.map(self._head, urls)))
+
+    def probe(self, urls):
+        """Gets the HTTP status of each url, or None if it could not be reached.
+
+        Returns:
+                A dict of url to status.
+        """
+        return {u: meta and meta['status'] for u, meta in self.head(urls).items()}
+
+    def _get(self, u, PATH, telemetry):
+        file_name_and_path = target_path(u, PATH)
+        error = None
+        #try the request a second time before giving up on this file
+        for attempt in range(2):
+            if attempt and telemetry:
+                telemetry.retry(u)
+            try:
+                with self._session().get(u, stream=True, timeout=self.timeout) as request:
+                    progress = telemetry.start(u, int(request.headers.get('Content-Length', 0)) or None) if telemetry else None
+                    hash_md5 = hashlib.md5()
+                    hash_sha256 = hashlib.sha256()
+                    with open(file_name_and_path, "wb") as zip_file:
+                        for chunk in request.iter_content(chunk_size=self.chunk_size):
+                            zip_file.write(chunk)
+                            hash_md5.update(chunk)
+                            hash_sha256.update(chunk)
+                            if progress is not None:
+                                progress.done += len(chunk)
+                    return file_name_and_path, request.status_code, {'md5': hash_md5.hexdigest(), 'sha256': hash_sha256.hexdigest()}, None
+            except requests.exceptions.RequestException as e:
+                error = e
+        return file_name_and_path, None, None, error
+
+    def download(self, urls, PATH, logfile, telemetry=None):
+        """Downloads zip files into a year folder, logging each one as it finishes.
+
+        Arg:
+                urls: Urls of the zip files.
+                PATH: Year folder to save them in.
+                logfile: Open log file.
+                telemetry: fpds_telemetry.Telemetry to count their bytes in, or None.
+        Returns:
+                A dict of url to (saved file's path, whether the server returned it, hashes),
+                like fpds_common.download_archive returns.
+        """
+        results = {}
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(self._get, u, PATH, telemetry) for u in urls]
+            #log from this thread only, in the order the urls were given
+            for u, future in zip(urls, futures):
+                file_name_and_path, status, hashes, error = future.result()
+                log_result(logfile, u, file_name_and_path, status, hashes, error)
+                results[u] = (file_name_and_path, status == 200, hashes)
+                if telemetry:
+                    telemetry.finish(u, status == 200)
+        return results
+
+
+class AsyncTransport:
+    """Probes and downloads with asyncio and aiohttp, every connection on one thread.
+
+    Arg:
+            per_host: Downloads open at once to one server.
+            probe_per_host: Probes open at once to one server.
+            chunk_size: Bytes read from the server per chunk.
+            timeout: Seconds to wait for the server to connect or send more data.
+            writers: Threads writing and hashing downloaded chunks.
+    """
+    name = "async"
+
+    def __init__(self, per_host=16, probe_per_host=200, chunk_size=CHUNK_SIZE, timeout=TIMEOUT, writers=4):
+        if aiohttp is None:
+            raise ImportError("AsyncTransport needs aiohttp: pip install aiohttp")
+        self.per_host = per_host
+        self.probe_per_host = probe_per_host
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.writers = writers
+
+    def _client(self, per_host):
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=per_host)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def head(self, urls):
+        """Gets the status, size and date modified of each url.
+
+        Returns:
+                A dict of url to a dict of 'status', 'size' and 'last_modified' (None if not
+                sent), or to None if the url could not be reached.
+        """
+        return asyncio.run(self._head(urls))
+
+    def probe(self, urls):
+        """Gets the HTTP status of each url, or None if it could not be reached.
+
+        Returns:
+                A dict of url to status.
+        """
+        return {u: meta and meta['status'] for u, meta in self.head(urls).items()}
+
+    async def _head(self, urls):
+        async with self._client(self.probe_per_host) as session:
+            async def head(u):
+                try:
+                    async with session.head(u, allow_redirects=True) as response:
+                        return head_metadata(response.status, response.headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    return None
+            return dict(zip(urls, await asyncio.gather(*[head(u) for u in urls])))
+
+    def download(self, urls, PATH, logfile, telemetry=None):
+        """Downloads zip files into a year folder, logging each one as it finishes.
+
+        Arg:
+                urls: Urls of the zip files.
+                PATH: Year folder to save them in.
+                logfile: Open log file.
+                telemetry: fpds_telemetry.Telemetry to count their bytes in, or None.
+        Returns:
+                A dict of url to (saved file's path, whether the server returned it, hashes),
+                like fpds_common.download_archive returns.
+        """
+        return asyncio.run(self._download(urls, PATH, logfile, telemetry))
+
+    async def _download(self, urls, PATH, logfile, telemetry):
+        results = {}
+        with ThreadPoolExecutor(self.writers) as writer:
+            async with self._client(self.per_host) as session:
+                async def fetch(u):
+                    file_name_and_path, status, hashes, error = await self._get(session, writer, u, PATH, telemetry)
+                    #every coroutine runs on this one thread, so the log needs no lock
+                    log_result(logfile, u, file_name_and_path, status, hashes, error)
+                    results[u] = (file_name_and_path, status == 200, hashes)
+                    if telemetry:
+                        telemetry.finish(u, status == 200)
+                await asyncio.gather(*[fetch(u) for u in urls])
+        return {u: results[u] for u in urls}
+
+    async def _get(self, session, writer, u, PATH, telemetry):
+        loop = asyncio.get_running_loop()
+        file_name_and_path = target_path(u, PATH)
+        error = None
+        #try the request a second time before giving up on this file
+        for attempt in range(2):
+            if attempt and telemetry:
+                telemetry.retry(u)
+            try:
+                async with session.get(u) as response:
+                    progress = telemetry.start(u, response.content_length) if telemetry else None
+                    hash_md5 = hashlib.md5()
+                    hash_sha256 = hashlib.sha256()
+                    zip_file = await loop.run_in_executor(writer, open, file_name_and_path, "wb")
+                    try:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            #each chunk is written before the next is read, so the file stays in order
+                            await loop.run_in_executor(writer, write_chunk, zip_file, chunk, hash_md5, hash_sha256)
+                            if progress is not None:
+                                progress.done += len(chunk)
+                    finally:
+                        await loop.run_in_executor(writer, zip_file.close)
+                    return file_name_and_path, response.status, {'md5': hash_md5.hexdigest(), 'sha256': hash_sha256.hexdigest()}, None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+        return file_name_and_path, None, None, error
+
+
+def write_chunk(zip_file, chunk, hash_md5, hash_sha256):
+    """Writes and hashes one chunk; run on a writer thread, where hashing does not hold the GIL."""
+    zip_file.write(chunk)
+    hash_md5.update(chunk)
+    hash_sha256.update(chunk)
+
+
+def make_transport(engine, concurrency=16):
+    """Makes a transport by name.
+
+    Arg:
+            engine: "async" or "threads".
+            concurrency: Downloads at once (threads also use this many for probes).
+    Returns:
+            An AsyncTransport or ThreadedTransport.
+    """
+    if engine == "async":
+        return AsyncTransport(per_host=concurrency)
+    if engine == "threads":
+        return ThreadedTransport(workers=concurrency)
+    raise ValueError("Unknown engine %s" % engine)